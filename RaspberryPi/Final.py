@@ -1,10 +1,13 @@
 import asyncio
-import subprocess
 import websockets
 import json
 import os
 import base64
+import random
+import struct
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import sounddevice as sd
 import numpy as np
@@ -12,80 +15,32 @@ from adafruit_servokit import ServoKit
 
 
 import smbus2
-import time
+from pca9685 import PCA9685, PanTilt
 
-# PCA9685 default I2C address
-PCA9685_ADDR = 0x40
-
-# Registers
-MODE1 = 0x00
-PRESCALE = 0xFE
-LED0_ON_L = 0x06
-
-# Initialize the data bus which is in the raspberry pi's i2c-3
-bus = smbus2.SMBus(3)  
-
-# Set up PCA9685 into normal mode
-bus.write_byte_data(PCA9685_ADDR, MODE1, 0x00)  
-
-# Set frequency to 50Hz for servos, and send byte data to the bus to prepare for servos
-freq = 50
-prescale_val = int(25000000.0 / (4096 * freq) - 1)
-old_mode = bus.read_byte_data(PCA9685_ADDR, MODE1)
-sleep_mode = (old_mode & 0x7F) | 0x10
-bus.write_byte_data(PCA9685_ADDR, MODE1, sleep_mode)
-bus.write_byte_data(PCA9685_ADDR, PRESCALE, prescale_val)
-bus.write_byte_data(PCA9685_ADDR, MODE1, old_mode)
-time.sleep(0.005)
-bus.write_byte_data(PCA9685_ADDR, MODE1, old_mode | 0xA1)
-
-# Set servo positions
-def set_pwm(channel, on, off):
-    reg = LED0_ON_L + 4 * channel
-    bus.write_byte_data(PCA9685_ADDR, reg, on & 0xFF)
-    bus.write_byte_data(PCA9685_ADDR, reg + 1, on >> 8)
-    bus.write_byte_data(PCA9685_ADDR, reg + 2, off & 0xFF)
-    bus.write_byte_data(PCA9685_ADDR, reg + 3, off >> 8)
-# 0 is left right, 1 is up down
-
-def smooth_set_pwm(channel, start, end, step=1, delay=0.005):
-    if start == end:
-        return
-    direction = 1 if end > start else -1
-    for pos in range(start, end, direction * step):
-        set_pwm(channel, 0, pos)
-        time.sleep(delay)
-    set_pwm(channel, 0, end)
+# The PCA9685 driving the camera servos sits on the raspberry pi's i2c-3
+pca = PCA9685(smbus2.SMBus(3))
+# 50Hz for servos
+pca.configure(50)
 
 #On startup these are the motor's middle position to be set when started
-updown = 300 
-leftright = 300
-
-set_pwm(0, 0, leftright)   
-set_pwm(1, 0, updown)   
-
-def move_cam(direction):
-    global leftright, updown
+camera = PanTilt(pca, pan=300, tilt=300)
 
-    if direction == "left" and leftright > 150:
-        new_pos = max(150, leftright - 25)
-        smooth_set_pwm(0, leftright, new_pos)
-        leftright = new_pos
+# Each nudge moves the camera 25 steps, within 150..600 on both axes
+CAM_STEP = 25
+CAM_MIN = 150
+CAM_MAX = 600
 
-    elif direction == "right" and leftright < 600:
-        new_pos = min(600, leftright + 25)
-        smooth_set_pwm(0, leftright, new_pos)
-        leftright = new_pos
-
-    elif direction == "down" and updown > 150:
-        new_pos = max(150, updown - 25)
-        smooth_set_pwm(1, updown, new_pos)
-        updown = new_pos
-
-    elif direction == "up" and updown < 600:
-        new_pos = min(600, updown + 25)
-        smooth_set_pwm(1, updown, new_pos)
-        updown = new_pos
+def cam_target_after(pan, tilt, direction, steps=1):
+    """Where the camera should end up after `steps` nudges in a direction."""
+    if direction == "left":
+        pan = max(CAM_MIN, pan - CAM_STEP * steps)
+    elif direction == "right":
+        pan = min(CAM_MAX, pan + CAM_STEP * steps)
+    elif direction == "down":
+        tilt = max(CAM_MIN, tilt - CAM_STEP * steps)
+    elif direction == "up":
+        tilt = min(CAM_MAX, tilt + CAM_STEP * steps)
+    return pan, tilt
 
 
 kit = ServoKit(channels=16)
@@ -98,51 +53,611 @@ def run_motor(motor_num):
     time.sleep(2)
     kit.servo[motor_num].angle = 90
 
-async def play_audio(data: bytes):
-    process = subprocess.Popen([
-        "ffmpeg", "-hide_banner", "-loglevel", "error",
-            "-i", "pipe:0",                
-            "-f", "wav", "pipe:1"          
-    ],
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE)
-    aplay = subprocess.Popen(
-        ["aplay"],
-        stdin=process.stdout,
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL
-    )
-
-    process.stdin.write(data)
-    process.stdin.close()
-    process.wait()
-    aplay.wait()
-
-
-async def send_data():
-    uri = "wss://petpal-3yfg.onrender.com/ws/live"
+# Audio is decoded by one ffmpeg per stream and played by a single long-lived aplay,
+# so playback starts on the first chunk and never blocks the websocket loop
+SAMPLE_RATE = 44100
+FLAG_START = 0x01
+FLAG_END = 0x02
+AUDIO_STREAM_IDLE = float(os.getenv("PETPAL_AUDIO_STREAM_IDLE", 10))  # seconds without a chunk before a stream is ended
+AUDIO_DECODER_GRACE = 5  # extra seconds a decoder holding the speaker may go silent before it is killed
 
-    async with websockets.connect(uri, ping_interval=20, ping_timeout=20) as websocket:
-        print("Connected to Server")
+class AudioPlayer:
+    """
+    A stream that stops arriving (the browser went away, its last frame was
+    dropped or expired, the connection broke) is ended after AUDIO_STREAM_IDLE
+    seconds, so it can't hold the speaker and block every stream after it. A
+    decoder that holds the speaker without producing anything is killed.
+    """
+
+    def __init__(self):
+        self.aplay = None
+        self.decoders = {}  # stream id -> ffmpeg process
+        self.last_fed = {}  # stream id -> monotonic time of its last chunk
+        self.draining = None  # stream waiting for its decoder to take a chunk, it isn't idle
+        self.output_lock = asyncio.Lock()  # one stream at a time into aplay
+
+    async def _output(self):
+        if self.aplay is None or self.aplay.returncode is not None:
+            self.aplay = await asyncio.create_subprocess_exec(
+                "aplay", "-q", "-t", "raw", "-f", "S16_LE", "-r", str(SAMPLE_RATE), "-c", "1",
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL)
+        return self.aplay
+
+    async def start(self, stream_id):
+        decoder = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-hide_banner", "-loglevel", "error",
+            "-i", "pipe:0",
+            "-f", "s16le", "-ac", "1", "-ar", str(SAMPLE_RATE), "pipe:1",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE)
+        self.decoders[stream_id] = decoder
+        self.last_fed[stream_id] = time.monotonic()
+        asyncio.create_task(self._pump(decoder))
+        asyncio.create_task(self._watch(stream_id, decoder))
+
+    async def _watch(self, stream_id, decoder):
+        while self.decoders.get(stream_id) is decoder:
+            idle = time.monotonic() - self.last_fed[stream_id]
+            if idle >= AUDIO_STREAM_IDLE and self.draining != stream_id:
+                print(f"Audio stream {stream_id} idle for {idle:.0f}s, ending it")
+                self.end(stream_id)
+                break
+            await asyncio.sleep(max(AUDIO_STREAM_IDLE - idle, 1))
+
+    def end(self, stream_id):
+        decoder = self.decoders.pop(stream_id, None)
+        self.last_fed.pop(stream_id, None)
+        if decoder is not None and not decoder.stdin.is_closing():
+            decoder.stdin.close()
+
+    def end_all(self):
+        # after a reconnect nothing more will arrive for the streams in progress
+        for stream_id in list(self.decoders):
+            self.end(stream_id)
+
+    async def _pump(self, decoder):
+        # copy decoded samples into aplay as ffmpeg produces them
+        async with self.output_lock:
+            while True:
+                try:
+                    pcm = await asyncio.wait_for(decoder.stdout.read(4096), AUDIO_STREAM_IDLE + AUDIO_DECODER_GRACE)
+                except asyncio.TimeoutError:
+                    # an idle stream is ended before this, so ffmpeg is stuck
+                    decoder.kill()
+                    break
+                if not pcm:
+                    break
+                aplay = await self._output()
+                aplay.stdin.write(pcm)
+                await aplay.stdin.drain()
+        await decoder.wait()
+
+    async def feed(self, stream_id, flags, payload):
+        if flags & FLAG_START or stream_id not in self.decoders:
+            self.end(stream_id)
+            await self.start(stream_id)
+        decoder = self.decoders[stream_id]
+        if payload:
+            decoder.stdin.write(payload)
+            self.draining = stream_id
+            try:
+                await decoder.stdin.drain()
+            finally:
+                self.draining = None
+        if self.decoders.get(stream_id) is not decoder:
+            return  # ended while we waited
+        self.last_fed[stream_id] = time.monotonic()
+        if flags & FLAG_END:
+            self.end(stream_id)
+
+    async def play(self, data):
+        # a whole clip from a server that does not stream
+        await self.feed(0, FLAG_START | FLAG_END, data)
+
+audio_player = AudioPlayer()
+
+
+#device topic this dispenser is registered under in user_devices
+DEVICE_TOPIC = os.getenv("PETPAL_DEVICE", "default")
+# the key issued for that device; the server closes the connection without it
+DEVICE_KEY = os.getenv("PETPAL_DEVICE_KEY", "")
+SERVER_URI = os.getenv("PETPAL_SERVER", "wss://petpal-3yfg.onrender.com")
+
+# Reconnect delays double from RECONNECT_MIN up to RECONNECT_MAX seconds, with jitter so a
+# fleet of dispensers doesn't reconnect in lockstep after a server redeploy
+RECONNECT_MIN = float(os.getenv("PETPAL_RECONNECT_MIN", 0.5))
+RECONNECT_MAX = float(os.getenv("PETPAL_RECONNECT_MAX", 30))
+HEALTH_FILE = os.getenv("PETPAL_HEALTH_FILE", "petpal_health.json")
+HEALTH_WRITE_INTERVAL = 5
+TRACE_REPORT_BUFFER = 100  # finished command traces held for the server while disconnected
+
+
+# Binary frames from the server: header then raw payload, must match app/protocol.py
+FRAME_VERSION = 1
+FRAME_HEADER = struct.Struct("!BBBxII")  # version, kind, flags, reserved, stream id, payload length
+KIND_AUDIO = 1
+KIND_VIDEO = 2
+PROTO_BINARY = 2
+
+def encode_frame(kind, payload, stream_id=0, flags=FLAG_START | FLAG_END):
+    frame = bytearray(FRAME_HEADER.size + len(payload))
+    FRAME_HEADER.pack_into(frame, 0, FRAME_VERSION, kind, flags, stream_id, len(payload))
+    frame[FRAME_HEADER.size:] = payload
+    return bytes(frame)
+
+def decode_frame(data):
+    """Return (kind, flags, stream_id, payload) with payload as a memoryview into data."""
+    view = memoryview(data)
+    if len(view) < FRAME_HEADER.size:
+        raise ValueError("Frame shorter than header")
+    version, kind, flags, stream_id, length = FRAME_HEADER.unpack_from(view)
+    if version != FRAME_VERSION:
+        raise ValueError(f"Unsupported frame version {version}")
+    end = FRAME_HEADER.size + length
+    if len(view) < end:
+        raise ValueError("Frame payload truncated")
+    return kind, flags, stream_id, view[FRAME_HEADER.size:end]
+
+class DeviceRuntime:
+    """
+    One worker per actuator, so a dispense, a camera move and audio playback can
+    run at the same time and none of them holds up the websocket.
+
+    The blocking servo code runs on a single-thread executor per actuator, which
+    also keeps each actuator's moves in order. Camera nudges only move a target
+    position; nudges that arrive while the camera is still moving are combined
+    into one move to wherever they add up to.
+
+    Traced commands get their actuation start and end added to the trace, which
+    is queued for the server and survives reconnects, the oldest reports going
+    first if more than TRACE_REPORT_BUFFER pile up.
+    """
+
+    def __init__(self):
+        self.motor_queue = asyncio.Queue()
+        self.audio_queue = asyncio.Queue()
+        self.cam_target = (camera.pan, camera.tilt)
+        self.cam_moved = asyncio.Event()
+        self.motor_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="motor")
+        self.cam_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cam")
+        self.video = VideoSource(VIDEO_DEVICE, VIDEO_FPS, VIDEO_QUALITY)
+        self.cam_traces = []
+        self.trace_reports = deque(maxlen=TRACE_REPORT_BUFFER)
+        self.trace_ready = asyncio.Event()
+        self.tasks = []
+
+    def start(self):
+        self.tasks = [
+            asyncio.create_task(self.motor_worker()),
+            asyncio.create_task(self.cam_worker()),
+            asyncio.create_task(self.audio_worker()),
+        ]
+
+    def dispense(self, motor_num, trace=None):
+        self.motor_queue.put_nowait((motor_num, trace))
+
+    def nudge_cam(self, direction, steps=1, traces=()):
+        self.cam_target = cam_target_after(*self.cam_target, direction, steps)
+        self.cam_traces.extend(traces)
+        self.cam_moved.set()
+
+    def play(self, stream_id, flags, payload):
+        self.audio_queue.put_nowait((stream_id, flags, payload))
+
+    def reset_audio(self):
+        # queued behind what already arrived, so streams that were received whole still play
+        self.audio_queue.put_nowait(None)
+
+    def finish_trace(self, kind, trace, started, ok):
+        if trace is None:
+            return
+        trace = {**trace, "started": started, "finished": time.time()}
+        self.trace_reports.append({"type": "trace", "kind": kind, "ok": ok, "trace": trace})
+        self.trace_ready.set()
+
+    async def report_traces(self, websocket):
         while True:
+            while not self.trace_reports:
+                self.trace_ready.clear()
+                await self.trace_ready.wait()
+            report = self.trace_reports[0]
+            # stamped on every send, so the server can tell time held here from time on the network
+            await websocket.send(json.dumps({**report, "trace": {**report["trace"], "reported": time.time()}}))
+            # only dropped once sent, so a report caught by a disconnect goes on the next connection
+            self.trace_reports.popleft()
+
+    async def motor_worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            motor_num, trace = await self.motor_queue.get()
+            started = time.time()
+            ok = True
+            try:
+                await loop.run_in_executor(self.motor_executor, run_motor, motor_num)
+            except Exception as e:
+                ok = False
+                print(f"Motor {motor_num} failed: {e}")
+            self.finish_trace("command", trace, started, ok)
+
+    async def cam_worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.cam_moved.wait()
+            self.cam_moved.clear()
+            pan, tilt = self.cam_target
+            # every nudge folded into this move finishes with it
+            traces, self.cam_traces = self.cam_traces, []
+            started = time.time()
+            ok = True
             try:
-                response = await asyncio.wait_for(websocket.recv(), timeout=0.01)
-                data = json.loads(response)
-                if data["type"] == "command":
-                    run_motor(data["motor"])
+                await loop.run_in_executor(self.cam_executor, camera.move_to, pan, tilt)
+            except Exception as e:
+                ok = False
+                print(f"Camera move failed: {e}")
+            for trace in traces:
+                self.finish_trace("cam", trace, started, ok)
+
+    async def audio_worker(self):
+        while True:
+            item = await self.audio_queue.get()
+            if item is None:
+                audio_player.end_all()
+                continue
+            stream_id, flags, payload = item
+            try:
+                await audio_player.feed(stream_id, flags, payload)
+            except Exception as e:
+                print(f"Audio stream {stream_id} failed: {e}")
+
+
+# Camera frames go up the same connection as the commands come down; the server relays them
+# to every viewer, so each frame is captured and encoded once however many people watch
+VIDEO_DEVICE = int(os.getenv("PETPAL_VIDEO_DEVICE", 0))
+VIDEO_FPS = float(os.getenv("PETPAL_VIDEO_FPS", 15))
+VIDEO_QUALITY = int(os.getenv("PETPAL_VIDEO_QUALITY", 70))
+
+# While nothing moves the camera is only checked MOTION_CHECK_FPS times a second and a
+# keepalive frame goes up every MOTION_KEEPALIVE seconds; full rate resumes on motion
+MOTION_GATING = os.getenv("PETPAL_MOTION_GATING", "1") == "1"
+MOTION_CHECK_FPS = float(os.getenv("PETPAL_MOTION_CHECK_FPS", 4))
+MOTION_KEEPALIVE = float(os.getenv("PETPAL_MOTION_KEEPALIVE", 10))
+MOTION_HOLD = float(os.getenv("PETPAL_MOTION_HOLD", 5))               # seconds of full rate after the last motion
+MOTION_EVENT_COOLDOWN = float(os.getenv("PETPAL_MOTION_COOLDOWN", 60))  # seconds between pet_detected events
+
+class MotionDetector:
+    """
+    Frame differencing on a downscaled grayscale copy.
+
+    Every `step`th pixel is kept, converted to gray with one matrix product and
+    compared with a running average of recent frames; motion is when more than
+    `area_threshold` of the pixels changed by more than `pixel_threshold`.
+    All of it is whole-array NumPy, a few ms per frame on a Pi.
+    """
+
+    GRAY_WEIGHTS = np.array([0.114, 0.587, 0.299], dtype=np.float32)  # BGR order, as cv2 reads it
+
+    def __init__(self, step=8, pixel_threshold=25, area_threshold=0.02, alpha=0.1):
+        self.step = step
+        self.pixel_threshold = pixel_threshold
+        self.area_threshold = area_threshold
+        self.alpha = alpha
+        self.background = None
+
+    def changed_share(self, frame):
+        small = frame[::self.step, ::self.step].astype(np.float32)
+        gray = small @ self.GRAY_WEIGHTS
+        if self.background is None or self.background.shape != gray.shape:
+            self.background = gray
+            return 0.0
+        diff = np.abs(gray - self.background)
+        # the average follows slow changes like daylight so they never count as motion
+        self.background += self.alpha * (gray - self.background)
+        return np.count_nonzero(diff > self.pixel_threshold) / diff.size
+
+    def update(self, frame):
+        """Return (motion, share of pixels changed) for the next frame."""
+        share = self.changed_share(frame)
+        return share > self.area_threshold, share
+
+
+class VideoSource:
+    """
+    Camera capture for the server relay. The server sends {"type": "video_ctl", ...}
+    to pause it while nobody watches and to trade fps, JPEG quality and size
+    against how well the viewers keep up. With motion gating, frames are only
+    encoded and sent at full rate while something moves in view, and while
+    paused the camera is still checked at MOTION_CHECK_FPS so pet_detected
+    events go out with nobody watching; only the encoding and sending stop.
+    """
+
+    def __init__(self, device, fps, quality, gating=MOTION_GATING):
+        self.device = device
+        self.fps = fps
+        self.quality = quality
+        self.scale = 1.0
+        self.capture = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="video")
+        self.resumed = asyncio.Event()
+        self.resumed.set()
+        self.motion = MotionDetector() if gating else None
+        self.last_motion = None
+        self.last_sent = None
+        self.last_event = None
+
+    def apply(self, settings):
+        self.fps = settings.get("fps", self.fps)
+        self.quality = settings.get("quality", self.quality)
+        self.scale = settings.get("scale", self.scale)
+        if settings.get("paused"):
+            self.resumed.clear()
+        else:
+            self.resumed.set()
+        print(f"Video settings: {settings}")
+
+    def grab(self):
+        """Read a frame and check it for motion; blocking, runs on the video executor."""
+        if self.capture is None or not self.capture.isOpened():
+            self.capture = cv2.VideoCapture(self.device)
+        ok, frame = self.capture.read()
+        if not ok:
+            return None, False, 0.0
+        if self.motion is None:
+            return frame, True, 0.0
+        motion, share = self.motion.update(frame)
+        return frame, motion, share
+
+    def encode(self, frame):
+        if self.scale < 1.0:
+            frame = cv2.resize(frame, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        ok, jpeg = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        return jpeg.tobytes() if ok else None
+
+    def active(self, now):
+        return self.last_motion is not None and now - self.last_motion < MOTION_HOLD
+
+    async def stream(self, websocket):
+        """Send frames at up to `fps` until cancelled; a slow uplink just lowers the rate."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time()
+        try:
+            while True:
+                paused = not self.resumed.is_set()
+                if paused and self.motion is None:
+                    # nothing to watch for without motion gating, leave the camera alone
+                    await self.resumed.wait()
+                    deadline = loop.time()
+                    continue
+                frame, motion, share = await loop.run_in_executor(self.executor, self.grab)
+                if frame is None:
+                    # no camera or a bad read, try again shortly instead of spinning
+                    await asyncio.sleep(1)
+                    deadline = loop.time()
+                    continue
+
+                now = loop.time()
+                if motion:
+                    if not self.active(now) and self.motion is not None and (
+                            self.last_event is None or now - self.last_event >= MOTION_EVENT_COOLDOWN):
+                        self.last_event = now
+                        await websocket.send(json.dumps({
+                            "type": "event", "event": "pet_detected", "score": round(share, 3), "time": time.time()}))
+                    self.last_motion = now
+
+                active = self.active(now) and not paused
+                if not paused and (active or self.last_sent is None or now - self.last_sent >= MOTION_KEEPALIVE):
+                    jpeg = await loop.run_in_executor(self.executor, self.encode, frame)
+                    if jpeg is not None:
+                        await websocket.send(encode_frame(KIND_VIDEO, jpeg))
+                        self.last_sent = now
+
+                deadline += 1 / (self.fps if active else min(self.fps, MOTION_CHECK_FPS))
+                delay = deadline - loop.time()
+                if delay <= 0:
+                    deadline = loop.time()
+                elif not paused:
+                    await asyncio.sleep(delay)
+                else:
+                    # a viewer arriving ends the wait at once
+                    try:
+                        await asyncio.wait_for(self.resumed.wait(), delay)
+                        deadline = loop.time()
+                    except asyncio.TimeoutError:
+                        pass
+        except websockets.exceptions.ConnectionClosed:
+            # the command loop notices too and reconnects
+            return
+
+
+class ConnectionHealth:
+    """
+    Connection state and reconnect metrics, kept in memory and mirrored to HEALTH_FILE.
+
+    Also remembers the id of the last command acked, which is sent to the
+    server on reconnect (and survives a restart of this script) so the server
+    doesn't resend commands that were already run.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.state = "starting"
+        self.since = time.time()
+        self.last_error = None
+        self.attempts = 0  # failed attempts since the last successful connect
+        self.reconnects = 0
+        self.last_outage_seconds = None
+        self.max_outage_seconds = 0.0
+        self.total_outage_seconds = 0.0
+        self.last_command_id = None
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.last_command_id = json.load(f).get("last_command_id")
+        except (OSError, ValueError):
+            pass
+
+    def connected(self):
+        now = time.time()
+        if self.state == "disconnected":
+            outage = now - self.since
+            self.reconnects += 1
+            self.last_outage_seconds = outage
+            self.max_outage_seconds = max(self.max_outage_seconds, outage)
+            self.total_outage_seconds += outage
+            print(f"Reconnected after {outage:.1f}s and {self.attempts} failed attempts")
+        self.state = "connected"
+        self.since = now
+        self.attempts = 0
+        self.write()
+
+    def disconnected(self, error):
+        if self.state == "disconnected":
+            self.attempts += 1
+        else:
+            self.state = "disconnected"
+            self.since = time.time()
+        self.last_error = error
+        self.write()
+
+    def processed(self, command_id):
+        self.last_command_id = command_id
+        self.dirty = True
+
+    def snapshot(self):
+        return {
+            "device": DEVICE_TOPIC,
+            "state": self.state,
+            "since": self.since,
+            "last_error": self.last_error,
+            "attempts": self.attempts,
+            "reconnects": self.reconnects,
+            "last_outage_seconds": self.last_outage_seconds,
+            "max_outage_seconds": self.max_outage_seconds,
+            "total_outage_seconds": self.total_outage_seconds,
+            "last_command_id": self.last_command_id,
+        }
+
+    def write(self):
+        # write then rename, so a reader never sees half a file
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+        except OSError as e:
+            print(f"Could not write {self.path}: {e}")
+
+    async def writer(self):
+        # the last command id changes often, so it is saved every few seconds rather than on each ack
+        while True:
+            await asyncio.sleep(HEALTH_WRITE_INTERVAL)
+            if self.dirty:
+                self.write()
+
+
+def reconnect_delay(attempt):
+    delay = min(RECONNECT_MAX, RECONNECT_MIN * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+# The server resends motor/cam commands we have not acked when we reconnect, so an ack can
+# get lost and the same command arrive twice; remember recent ids to run each one once
+recent_ids = deque(maxlen=256)
+
+def first_time_seen(command_id):
+    if command_id in recent_ids:
+        return False
+    recent_ids.append(command_id)
+    return True
+
+async def send_data(runtime, health):
+    uri = f"{SERVER_URI}/ws/live?device={DEVICE_TOPIC}&proto={PROTO_BINARY}&ack=1"
+    if health.last_command_id is not None:
+        # resume: everything up to this id already ran here, the server need not resend it
+        uri += f"&resume={health.last_command_id}"
+
+    async with websockets.connect(uri, ping_interval=20, ping_timeout=20) as websocket:
+        # must be the first message, before any ack, trace or video frame
+        await websocket.send(json.dumps({"type": "hello", "key": DEVICE_KEY}))
+        print("Connected to Server")
+        health.connected()
+        # audio is not redelivered, streams cut off by the last disconnect will never finish
+        runtime.reset_audio()
+        video_task = asyncio.create_task(runtime.video.stream(websocket))
+        trace_task = asyncio.create_task(runtime.report_traces(websocket))
+        try:
+            await receive_commands(websocket, runtime, health)
+        finally:
+            video_task.cancel()
+            trace_task.cancel()
+
+
+async def receive_commands(websocket, runtime, health):
+    # waits for each message as it arrives; the actuators run on their own workers
+    async for response in websocket:
+        if isinstance(response, bytes):
+            kind, flags, stream_id, payload = decode_frame(response)
+            if kind == KIND_AUDIO:
+                runtime.play(stream_id, flags, payload)
+            continue
+
+        data = json.loads(response)
+        if data["type"] in ("command", "cam"):
+            # ack on receipt, a dispense that is retried after a crash mid-run would double up
+            await websocket.send(json.dumps({"type": "ack", "id": data["id"]}))
+            if not first_time_seen(data["id"]):
+                continue
+            health.processed(data["id"])
+
+        # timestamps for the server's latency tracing, sent back once the move is done;
+        # a merged camera nudge also carries the traces of the nudges folded into it
+        traces = [trace for trace in [data.get("trace"), *data.get("merged_traces", [])] if trace is not None]
+        received = time.time()
+        for trace in traces:
+            trace["received"] = received
+
+        if data["type"] == "command":
+            runtime.dispense(data["motor"], traces[0] if traces else None)
+
+        elif data["type"] == "cam":
+            #the server merges repeated nudges into one message with a step count
+            runtime.nudge_cam(data["direction"], data.get("steps", 1), traces)
+
+        elif data["type"] == "audio":
+            audio_bytes = base64.b64decode(data["data"])
+            runtime.play(0, FLAG_START | FLAG_END, audio_bytes)
+
+        elif data["type"] == "video_ctl":
+            runtime.video.apply(data)
 
-                elif data["type"] == "cam":
-                    move_cam(data["direction"])
 
-                elif data["type"] == "audio":
-                    audio_bytes = base64.b64decode(data["data"])
-                    await play_audio(audio_bytes)
+async def main():
+    if not DEVICE_KEY:
+        print("PETPAL_DEVICE_KEY is not set, the server will refuse this device")
+    runtime = DeviceRuntime()
+    runtime.start()
+    health = ConnectionHealth(HEALTH_FILE)
+    # the saved id survives a restart, so the command that was running when the pi went down isn't run again
+    if health.last_command_id is not None:
+        recent_ids.append(health.last_command_id)
+    asyncio.create_task(health.writer())
 
-            except asyncio.TimeoutError:
-                pass
+    # keep going through network drops and server restarts; the workers carry on meanwhile
+    while True:
+        try:
+            await send_data(runtime, health)
+            error = "connection closed"
+        except Exception as e:
+            error = repr(e)
+        health.disconnected(error)
+        delay = reconnect_delay(health.attempts)
+        print(f"Disconnected ({error}), retrying in {delay:.1f}s")
+        await asyncio.sleep(delay)
 
-            await asyncio.sleep(0.1)
 
-        
-asyncio.run(send_data())
-                    
\ No newline at end of file
+asyncio.run(main())
@@ -0,0 +1,113 @@
+"""
+PCA9685 PWM driver for the camera's pan/tilt servos.
+
+Channel registers are written with auto-increment block writes, so a channel
+update is one I2C transaction instead of four, and neighbouring channels (pan
+on 0, tilt on 1) go out together. The bus is anything with smbus2.SMBus's
+read_byte_data/write_byte_data/write_i2c_block_data, so a fake can stand in
+for it off the Pi; `transactions` counts what was sent.
+"""
+import math
+import time
+
+# PCA9685 default I2C address
+PCA9685_ADDR = 0x40
+
+# Registers
+MODE1 = 0x00
+PRESCALE = 0xFE
+LED0_ON_L = 0x06
+
+# MODE1 bits
+MODE1_ALLCALL = 0x01
+MODE1_SLEEP = 0x10
+MODE1_AI = 0x20  # auto-increment the register address after each byte
+MODE1_RESTART = 0x80
+
+OSC_HZ = 25000000
+MAX_BLOCK = 32  # SMBus block write limit, i.e. 8 channels
+
+# 0 is left right, 1 is up down
+PAN_CHANNEL = 0
+TILT_CHANNEL = 1
+
+
+class PCA9685:
+    def __init__(self, bus, address=PCA9685_ADDR):
+        self.bus = bus
+        self.address = address
+        self.transactions = 0
+
+    def read_register(self, reg):
+        self.transactions += 1
+        return self.bus.read_byte_data(self.address, reg)
+
+    def write_register(self, reg, value):
+        self.transactions += 1
+        self.bus.write_byte_data(self.address, reg, value)
+
+    def configure(self, freq=50):
+        """Wake the chip, set the PWM frequency (50Hz for servos) and turn on auto-increment."""
+        self.write_register(MODE1, 0x00)
+        prescale_val = int(OSC_HZ / (4096 * freq) - 1)
+        old_mode = self.read_register(MODE1)
+        # the prescaler can only be changed while asleep
+        self.write_register(MODE1, (old_mode & 0x7F) | MODE1_SLEEP)
+        self.write_register(PRESCALE, prescale_val)
+        self.write_register(MODE1, old_mode)
+        time.sleep(0.005)
+        self.write_register(MODE1, old_mode | MODE1_RESTART | MODE1_AI | MODE1_ALLCALL)
+
+    def set_pwm(self, channel, on, off):
+        self.set_pwms(channel, [(on, off)])
+
+    def set_pwms(self, first_channel, values):
+        """Set consecutive channels starting at first_channel from (on, off) pairs in one transaction."""
+        data = []
+        for on, off in values:
+            data += [on & 0xFF, on >> 8, off & 0xFF, off >> 8]
+        if len(data) > MAX_BLOCK:
+            raise ValueError(f"At most {MAX_BLOCK // 4} channels per write")
+        self.transactions += 1
+        self.bus.write_i2c_block_data(self.address, LED0_ON_L + 4 * first_channel, data)
+
+
+class PanTilt:
+    """
+    Pan and tilt servos moved together in a straight line.
+
+    A move is split into ticks of `period` seconds at `speed` PWM counts per
+    second (the old per-step loop moved one count every 5ms, i.e. 200/s), and
+    every tick writes both channels in one block. Ticks are timed against
+    monotonic deadlines so slow I2C writes don't stretch the move.
+    """
+
+    def __init__(self, pca, pan, tilt, speed=200, period=0.02, clock=time.monotonic, sleep=time.sleep):
+        self.pca = pca
+        self.speed = speed
+        self.period = period
+        self.clock = clock
+        self.sleep = sleep
+        self.pan = pan
+        self.tilt = tilt
+        self._write(pan, tilt)
+
+    def _write(self, pan, tilt):
+        self.pca.set_pwms(PAN_CHANNEL, [(0, pan), (0, tilt)])
+
+    def move_to(self, pan, tilt):
+        distance = max(abs(pan - self.pan), abs(tilt - self.tilt))
+        if distance == 0:
+            return
+        ticks = max(1, math.ceil(distance / (self.speed * self.period)))
+        start_pan, start_tilt = self.pan, self.tilt
+        deadline = self.clock()
+        for tick in range(1, ticks + 1):
+            if tick > 1:
+                deadline += self.period
+                delay = deadline - self.clock()
+                if delay > 0:
+                    self.sleep(delay)
+            fraction = tick / ticks
+            self._write(round(start_pan + (pan - start_pan) * fraction), round(start_tilt + (tilt - start_tilt) * fraction))
+        self.pan, self.tilt = pan, tilt
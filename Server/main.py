@@ -6,6 +6,8 @@ import numpy as np
 import requests
 from dotenv import load_dotenv
 import os
+import random
+import threading
 
 load_dotenv()
 
@@ -21,6 +23,24 @@ if BASE_TOPIC == "blueberries/ece140/sensors":
     print("Please enter a unique topic for your server")
     exit()
 
+# Bridge settings: readings are queued by the MQTT callback and posted in batches by a worker thread
+#SERVER_URL = "http://localhost:6543"
+SERVER_URL = os.getenv("SERVER_URL", "https://tech-assignment-final-project-emma-and-obr3.onrender.com")
+BATCH_URL = SERVER_URL + "/sensor_data/batch"
+BATCH_SIZE = int(os.getenv("BRIDGE_BATCH_SIZE", 200))
+BATCH_INTERVAL = float(os.getenv("BRIDGE_BATCH_INTERVAL", 1.0))  # seconds to wait for a batch to fill
+MAX_QUEUED = int(os.getenv("BRIDGE_MAX_QUEUED", 10000))  # readings kept in memory, oldest dropped beyond this
+RETRIES = int(os.getenv("BRIDGE_RETRIES", 5))
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+SPILL_PATH = os.getenv("BRIDGE_SPILL_PATH", "bridge_spill.jsonl")
+SPILL_MAX_BYTES = int(os.getenv("BRIDGE_SPILL_MAX_BYTES", 10 * 1024 * 1024))
+
+readings = deque()
+readings_ready = threading.Condition()
+stopping = threading.Event()
+dropped = 0
+
 
 def on_connect(client, userdata, flags, rc):
     """Callback for when the client connects to the broker."""
@@ -32,31 +52,29 @@ def on_connect(client, userdata, flags, rc):
         print(f"Failed to connect with result code {rc}")
 
 def on_message(client, userdata, msg):
-    """Callback for when a message is received."""
+    """Callback for when a message is received. Only queues the reading so the MQTT loop never waits on HTTP."""
+    global dropped
     #print("Message recieved")
     try:
         # Parse JSON message
         payload = json.loads(msg.payload.decode())
-        current_time = datetime.now()
         
         # check the topic if it is the base topic + /readings
         # if it is, print the payload
         print(payload)
-    
-
 
-        #Post the temperature and the pressure to our FASTAPI
-        #url = "http://localhost:8000/api/temperature"
-        #url = "http://localhost:6543/sensor_data"
-        url = "https://tech-assignment-final-project-emma-and-obr3.onrender.com/sensor_data"
         time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         topic = msg.topic[len(BASE_TOPIC) + 1:]
         data = {"temp": payload['temperature'], "timestamp": time, "topic": topic}
-        #print(data)
-        mypost = requests.post(url,json=data)
 
+        with readings_ready:
+            readings.append(data)
+            if len(readings) > MAX_QUEUED:
+                readings.popleft()
+                dropped += 1
+            if len(readings) >= BATCH_SIZE:
+                readings_ready.notify()
 
-            
     except json.JSONDecodeError:
         #print(f"\nReceived non-JSON message on {msg.topic}:")
 
@@ -64,13 +82,77 @@ def on_message(client, userdata, msg):
 
         print(f"Payload: {payload}")
 
-        # url = "http://localhost:8000/api/temperature"
-        # #url = "http://localhost:6543/api/temperature"
-        # time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        # data = {"value": str(payload['temperature']), "unit": "Celsius", "timestamp": str(time)}
-        # print(data)
-        # mypost = requests.post(url,json=data)
 
+def take_batch():
+    """Wait until a batch is full or BATCH_INTERVAL passes, then take up to BATCH_SIZE readings."""
+    with readings_ready:
+        if len(readings) < BATCH_SIZE and not stopping.is_set():
+            readings_ready.wait(BATCH_INTERVAL)
+        count = min(BATCH_SIZE, len(readings))
+        return [readings.popleft() for _ in range(count)]
+
+
+def post_batch(session, batch):
+    """Post one batch, retrying with jittered exponential backoff. Returns True once the server has it."""
+    for attempt in range(RETRIES):
+        delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+        try:
+            response = session.post(BATCH_URL, json=batch, timeout=10)
+            if response.status_code < 300:
+                return True
+            if response.status_code in (429, 503):
+                # server asked us to slow down
+                delay = max(delay, float(response.headers.get("Retry-After", 1)))
+            elif response.status_code < 500:
+                print(f"Server rejected batch of {len(batch)}: {response.status_code} {response.text}")
+                return True  # retrying will not help, do not spill it either
+        except requests.RequestException as e:
+            print(f"Posting batch failed: {e}")
+        if stopping.is_set():
+            break  # shutting down, let the caller spill it
+        stopping.wait(delay)
+    return False
+
+
+def spill(batch):
+    """Append a batch that could not be delivered to the on-disk spill file, up to SPILL_MAX_BYTES."""
+    size = os.path.getsize(SPILL_PATH) if os.path.exists(SPILL_PATH) else 0
+    lines = "".join(json.dumps(reading) + "\n" for reading in batch)
+    if size + len(lines) > SPILL_MAX_BYTES:
+        print(f"Spill file full, dropping {len(batch)} readings")
+        return
+    with open(SPILL_PATH, "a") as f:
+        f.write(lines)
+
+
+def replay_spill(session):
+    """Send spilled readings once the server is reachable again; keep whatever still fails."""
+    if not os.path.exists(SPILL_PATH):
+        return
+    with open(SPILL_PATH) as f:
+        spilled = [json.loads(line) for line in f if line.strip()]
+    os.remove(SPILL_PATH)
+    for start in range(0, len(spilled), BATCH_SIZE):
+        if not post_batch(session, spilled[start:start + BATCH_SIZE]):
+            spill(spilled[start:])
+            return
+    print(f"Replayed {len(spilled)} spilled readings")
+
+
+def bridge_worker():
+    """Batch queued readings and post them over one keep-alive session."""
+    session = requests.Session()
+    while True:
+        batch = take_batch()
+        if not batch:
+            if stopping.is_set():
+                break
+            continue
+        if post_batch(session, batch):
+            replay_spill(session)
+        else:
+            spill(batch)
+    session.close()
 
 
 def main():
@@ -81,6 +163,8 @@ def main():
     print("Setting callback functions...")
     client.on_message = on_message
     client.on_connect = on_connect
+    worker = threading.Thread(target=bridge_worker, name="bridge", daemon=True)
+    worker.start()
     try:
         # Connect to broker
         print("Connecting to broker...")
@@ -97,6 +181,14 @@ def main():
         print("Exited successfully")
     except Exception as e:
         print(f"Error: {e}")
+    finally:
+        # send (or spill) whatever is still queued before exiting
+        stopping.set()
+        with readings_ready:
+            readings_ready.notify()
+        worker.join()
+        if dropped:
+            print(f"Dropped {dropped} readings while the queue was full")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
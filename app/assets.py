@@ -0,0 +1,144 @@
+import glob
+import gzip
+import hashlib
+import html
+import logging
+import os
+import re
+from typing import Dict, Iterable
+
+from fastapi.responses import HTMLResponse, Response
+from fastapi.staticfiles import StaticFiles
+from starlette.requests import Request
+
+try:
+    import brotli  # optional, only used when installed
+except ImportError:
+    brotli = None
+
+
+logger = logging.getLogger(__name__)
+
+PUBLIC_DIR = "app/public"
+ASSET_RELOAD = os.getenv("ASSET_RELOAD", "0") == "1"          #re-read pages whose mtime changed (for development)
+STATIC_MAX_AGE = int(os.getenv("STATIC_MAX_AGE", 3600))       #seconds browsers may reuse /public files without asking
+
+
+def _accepted_encodings(request: Request) -> set:
+    accepted = set()
+    for token in request.headers.get("accept-encoding", "").split(","):
+        coding, _, params = token.strip().partition(";")
+        if params.replace(" ", "") in ("q=0", "q=0.0"):
+            continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+
+def _not_modified(request: Request, etags: Iterable[str]) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    wanted = {tag.strip().removeprefix("W/") for tag in header.split(",")}
+    return any(etag in wanted for etag in etags)
+
+
+class Asset:
+    """One HTML page held in memory, with its compressed variants and ETags."""
+
+    def __init__(self, body: bytes, mtime: float):
+        self.mtime = mtime
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        #strong ETags have to differ per encoding
+        self.variants = {None: (body, f'"{digest}"'), "gzip": (gzip.compress(body, 9), f'"{digest}-gz"')}
+        if brotli is not None:
+            self.variants["br"] = (brotli.compress(body), f'"{digest}-br"')
+
+    def response(self, request: Request, status_code: int = 200) -> Response:
+        accepted = _accepted_encodings(request)
+        encoding = next((coding for coding in ("br", "gzip") if coding in accepted and coding in self.variants), None)
+        body, etag = self.variants[encoding]
+        headers = {"ETag": etag, "Vary": "Accept-Encoding", "Cache-Control": "no-cache"}
+        if status_code == 200 and _not_modified(request, [etag for _, etag in self.variants.values()]):
+            return Response(status_code=304, headers=headers)
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        return HTMLResponse(content=body, status_code=status_code, headers=headers)
+
+
+class Template:
+    """A page with {field} placeholders, split once so rendering is a join of escaped values."""
+
+    def __init__(self, text: str, fields: Iterable[str], mtime: float):
+        self.mtime = mtime
+        pattern = "|".join(re.escape(field) for field in fields)
+        #odd indexes hold field names, even indexes the literal text between them
+        self.parts = re.split(r"\{(" + pattern + r")\}", text)
+
+    def render(self, **values: str) -> str:
+        parts = list(self.parts)
+        for index in range(1, len(parts), 2):
+            parts[index] = html.escape(values[parts[index]])
+        return "".join(parts)
+
+
+class AssetCache:
+    """
+    Keeps app/public pages in memory instead of reading them on every request.
+
+    Pages are served with gzip (and brotli when installed) variants, strong
+    ETags and 304 Not Modified. With ASSET_RELOAD=1 a page is reloaded when
+    its file's mtime changes.
+    """
+
+    def __init__(self, directory: str, reload: bool):
+        self.directory = directory
+        self.reload = reload
+        self._assets: Dict[str, Asset] = {}
+        self._templates: Dict[str, Template] = {}
+
+    def preload(self):
+        for path in glob.glob(os.path.join(self.directory, "*.html")):
+            self.asset(os.path.basename(path))
+        logger.info(f"Cached {len(self._assets)} pages from {self.directory}")
+
+    def _mtime(self, name: str) -> float:
+        return os.stat(os.path.join(self.directory, name)).st_mtime
+
+    def _read(self, name: str) -> bytes:
+        with open(os.path.join(self.directory, name), "rb") as f:
+            return f.read()
+
+    def asset(self, name: str) -> Asset:
+        asset = self._assets.get(name)
+        if asset is None or (self.reload and asset.mtime != self._mtime(name)):
+            mtime = self._mtime(name)
+            asset = self._assets[name] = Asset(self._read(name), mtime)
+        return asset
+
+    def template(self, name: str, fields: Iterable[str]) -> Template:
+        template = self._templates.get(name)
+        if template is None or (self.reload and template.mtime != self._mtime(name)):
+            mtime = self._mtime(name)
+            template = self._templates[name] = Template(self._read(name).decode(), fields, mtime)
+        return template
+
+    def page(self, request: Request, name: str, status_code: int = 200) -> Response:
+        return self.asset(name).response(request, status_code)
+
+
+class CachedStaticFiles(StaticFiles):
+    """StaticFiles (which already does ETag/304) plus a Cache-Control max-age."""
+
+    def __init__(self, *args, max_age: int = STATIC_MAX_AGE, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache_control = f"public, max-age={max_age}"
+
+    def file_response(self, *args, **kwargs) -> Response:
+        response = super().file_response(*args, **kwargs)
+        response.headers["Cache-Control"] = self.cache_control
+        return response
+
+
+asset_cache = AssetCache(PUBLIC_DIR, ASSET_RELOAD)
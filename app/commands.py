@@ -0,0 +1,488 @@
+import asyncio
+import itertools
+import json
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Optional
+
+from app import database
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DEVICE_TOPIC = os.getenv("DEFAULT_DEVICE_TOPIC", "default")  #used when a request names no device
+COMMAND_QUEUE_SIZE = int(os.getenv("COMMAND_QUEUE_SIZE", 32))       #pending commands kept per device
+COMMAND_BROKER = os.getenv("COMMAND_BROKER", "memory")              #"memory" (one worker) or "mysql" (shared)
+COMMAND_POLL_INTERVAL = float(os.getenv("COMMAND_POLL_INTERVAL", 0.1))  #seconds between checks for commands queued by other workers
+
+#seconds a command may wait for its device before it is thrown away; a late camera nudge is worse than none
+COMMAND_TTLS = {
+    "command": float(os.getenv("COMMAND_TTL_MOTOR", 600)),
+    "cam": float(os.getenv("COMMAND_TTL_CAM", 5)),
+    "audio": float(os.getenv("COMMAND_TTL_AUDIO", 30)),
+}
+
+#kinds that may be dropped (oldest first) to make room; anything else is refused when full.
+#audio is not: a stream missing its first frame can't be decoded and one missing its last never ends
+DROPPABLE_KINDS = ("cam",)
+#kinds a device confirms; they are kept until acked and sent again if it reconnects first.
+#audio frames are best effort, replaying half a stream after a reconnect would only garble it
+ACKED_KINDS = ("command", "cam")
+MAX_MERGED_TRACES = 32  #traces of folded-in nudges carried by one camera message; the rest just never complete
+
+
+class QueueFull(Exception):
+    """Raised when a device already has too many pending commands."""
+
+
+def _merge(last: dict, message: dict) -> bool:
+    """
+    Fold a camera nudge into the previous one if it goes the same way; True if merged.
+
+    The folded nudge's trace rides along in "merged_traces", so every request
+    that asked for the move still gets its trace back from the device. A
+    message marked "redelivered" may already have reached the device, which
+    would take it for a repeat of that id and drop the new nudge with it.
+    """
+    if last.get("redelivered"):
+        return False
+    if message["type"] != "cam" or last["type"] != "cam" or last["direction"] != message["direction"]:
+        return False
+    last["steps"] = last.get("steps", 1) + message.get("steps", 1)
+    if "trace" in message:
+        if "trace" not in last:
+            last["trace"] = message["trace"]
+        elif len(last.setdefault("merged_traces", [])) < MAX_MERGED_TRACES:
+            last["merged_traces"].append(message["trace"])
+    return True
+
+
+def _ttl(message: dict) -> float:
+    return COMMAND_TTLS.get(message["type"], COMMAND_TTLS["command"])
+
+
+class DeviceChannel:
+    """
+    Bounded queue of pending commands for one device.
+
+    Repeated camera nudges in the same direction are merged into one message
+    with a step count. When the queue is full the oldest camera nudge is
+    dropped to make room; motor commands and audio frames are never dropped,
+    the publisher gets QueueFull instead. Messages handed out are held in
+    flight until acked, count towards the limit, and go back to the front
+    of the queue on release() or redeliver(), marked "redelivered" so
+    nothing is merged into them. Messages past their "expires"
+    time are discarded instead of sent.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._items = deque()
+        self._in_flight: Dict[int, dict] = OrderedDict()
+        self._ready = asyncio.Event()
+
+    def __len__(self):
+        return len(self._items) + len(self._in_flight)
+
+    def put(self, message: dict) -> int:
+        self._prune(time.time())
+        if self._items and _merge(self._items[-1], message):
+            self._items[-1]["expires"] = max(self._items[-1]["expires"], message["expires"])
+            return self._items[-1]["id"]
+
+        if len(self) >= self.maxsize and not self._drop_one():
+            raise QueueFull()
+
+        self._items.append(message)
+        self._ready.set()
+        return message["id"]
+
+    def _prune(self, now: float):
+        if any(item["expires"] <= now for item in self._items):
+            self._items = deque(item for item in self._items if item["expires"] > now)
+        for message_id in [key for key, item in self._in_flight.items() if item["expires"] <= now]:
+            del self._in_flight[message_id]
+
+    def _drop_one(self) -> bool:
+        for kind in DROPPABLE_KINDS:
+            for index, item in enumerate(self._items):
+                if item["type"] == kind:
+                    del self._items[index]
+                    logger.info(f"Dropped queued {kind} message, device queue full")
+                    return True
+        return False
+
+    def _take(self, kinds: Optional[Iterable[str]]) -> Optional[dict]:
+        self._prune(time.time())
+        for index, item in enumerate(self._items):
+            if kinds is None or item["type"] in kinds:
+                del self._items[index]
+                return item
+        return None
+
+    async def get(self, kinds: Optional[Iterable[str]] = None) -> dict:
+        """Wait for the next message, optionally only of the given kinds; it stays in flight until acked."""
+        while True:
+            message = self._take(kinds)
+            if message is not None:
+                self._in_flight[message["id"]] = message
+                return message
+            self._ready.clear()
+            await self._ready.wait()
+
+    def ack(self, message_id: int):
+        self._in_flight.pop(message_id, None)
+
+    def ack_through(self, last_id: int):
+        #also those already back in the queue, released when the device's last socket closed
+        def ran(item: dict) -> bool:
+            return item["type"] in ACKED_KINDS and item["id"] <= last_id
+
+        for message_id in [key for key, item in self._in_flight.items() if ran(item)]:
+            del self._in_flight[message_id]
+        if any(ran(item) for item in self._items):
+            self._items = deque(item for item in self._items if not ran(item))
+
+    def discard_stream(self, stream_id: int) -> int:
+        kept = deque(item for item in self._items if item["type"] != "audio" or item["stream"] != stream_id)
+        removed = len(self._items) - len(kept)
+        self._items = kept
+        return removed
+
+    def release(self, message_ids: Iterable[int]):
+        """Put these unacked messages back at the front of the queue, oldest first."""
+        released = [self._in_flight.pop(message_id) for message_id in sorted(message_ids) if message_id in self._in_flight]
+        if not released:
+            return
+        for message in released:
+            message["redelivered"] = True
+        self._items.extendleft(reversed(released))
+        self._ready.set()
+
+    def redeliver(self):
+        """Put every unacked message back at the front of the queue, oldest first."""
+        self.release(list(self._in_flight))
+
+
+class CommandBroker:
+    """
+    Carries commands from the HTTP routes to the websocket of the device they are for.
+
+    Routes publish to a device topic (user_devices.device_topic) and the
+    device's websocket handler waits on next() for the same topic. Messages
+    are dicts with a "type" of command, cam or audio; audio messages carry
+    raw bytes under "data". publish() stamps each message with an increasing
+    integer "id" and an "expires" time from COMMAND_TTLS.
+
+    Every message next() hands out is claimed: nobody else gets it, but it
+    is only removed once ack() is called with its id, after it was sent (or,
+    for kinds the device confirms, once the device acks it). Until then
+    release() or redeliver() hand it out again, so a message taken by a
+    websocket that closes before sending it is not lost. Consumer tracks
+    this for one websocket.
+    """
+
+    async def start(self):
+        """Start any background work; called from the app lifespan."""
+
+    async def stop(self):
+        """Stop background work."""
+
+    async def publish(self, topic: str, message: dict) -> int:
+        """Queue a message for a device and return its id, raising QueueFull if it has too many pending."""
+        raise NotImplementedError
+
+    async def next(self, topic: str, kinds: Optional[Iterable[str]] = None) -> dict:
+        """Wait for and claim the next message for a device, optionally only of the given kinds."""
+        raise NotImplementedError
+
+    async def ack(self, topic: str, message_id: int):
+        """The message was delivered, forget it."""
+        raise NotImplementedError
+
+    async def release(self, topic: str, message_ids: Iterable[int]):
+        """Queue these claimed but unacked messages again."""
+        raise NotImplementedError
+
+    async def ack_through(self, topic: str, last_id: int):
+        """The device ran everything up to last_id, forget those commands whether in flight or queued again."""
+        raise NotImplementedError
+
+    async def redeliver(self, topic: str):
+        """Queue every delivered but unacked message for the device again."""
+        raise NotImplementedError
+
+    async def discard_stream(self, topic: str, stream_id: int) -> int:
+        """Remove an audio stream's frames that are still queued and return how many there were."""
+        raise NotImplementedError
+
+    async def depths(self) -> Dict[str, int]:
+        """Pending message count per device topic."""
+        raise NotImplementedError
+
+
+class InMemoryBroker(CommandBroker):
+    """Per-device channels in this process; only works when the device and the routes share a worker."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._channels: Dict[str, DeviceChannel] = {}
+        #ids start from the clock so they keep increasing across restarts, devices use them to spot repeats
+        self._ids = itertools.count(int(time.time() * 1000))
+
+    def channel(self, topic: str) -> DeviceChannel:
+        channel = self._channels.get(topic)
+        if channel is None:
+            channel = self._channels[topic] = DeviceChannel(self.maxsize)
+        return channel
+
+    async def publish(self, topic: str, message: dict) -> int:
+        message["id"] = next(self._ids)
+        message["expires"] = time.time() + _ttl(message)
+        return self.channel(topic).put(message)
+
+    async def next(self, topic: str, kinds: Optional[Iterable[str]] = None) -> dict:
+        return await self.channel(topic).get(kinds)
+
+    async def ack(self, topic: str, message_id: int):
+        self.channel(topic).ack(message_id)
+
+    async def release(self, topic: str, message_ids: Iterable[int]):
+        self.channel(topic).release(message_ids)
+
+    async def ack_through(self, topic: str, last_id: int):
+        self.channel(topic).ack_through(last_id)
+
+    async def redeliver(self, topic: str):
+        self.channel(topic).redeliver()
+
+    async def discard_stream(self, topic: str, stream_id: int) -> int:
+        return self.channel(topic).discard_stream(stream_id)
+
+    async def depths(self) -> Dict[str, int]:
+        return {topic: len(channel) for topic, channel in self._channels.items()}
+
+
+class MySQLBroker(CommandBroker):
+    """
+    Device queues kept in the device_commands table, shared by every worker and replica.
+
+    Consumers claim the oldest matching row with SELECT ... FOR UPDATE SKIP
+    LOCKED and mark it delivered in the same transaction, so a command is
+    handed to exactly one websocket no matter which worker accepted it. Rows
+    stay in the table until acked or expired, so unacked commands also
+    survive a server restart; a claim whose next() was cancelled before it
+    returned is released again. A publish on this worker wakes local
+    consumers straight away; commands accepted by other workers are picked
+    up within COMMAND_POLL_INTERVAL. Publishers to one device take turns on
+    its device_queues row. Merging and dropping follow the same rules as the
+    in-memory queues. Message ids are row ids.
+    """
+
+    def __init__(self, maxsize: int, poll_interval: float):
+        self.maxsize = maxsize
+        self.poll_interval = poll_interval
+        self._wakeups: Dict[str, asyncio.Event] = {}
+
+    def _wakeup(self, topic: str) -> asyncio.Event:
+        wakeup = self._wakeups.get(topic)
+        if wakeup is None:
+            wakeup = self._wakeups[topic] = asyncio.Event()
+        return wakeup
+
+    @staticmethod
+    def _encode(message: dict):
+        payload = {key: value for key, value in message.items() if key != "data"}
+        return json.dumps(payload), message.get("data")
+
+    @staticmethod
+    def _decode(row: dict) -> dict:
+        message = json.loads(row["payload"])
+        message["id"] = row["id"]
+        message["expires"] = row["expires_at"].timestamp()
+        if row["data"] is not None:
+            message["data"] = bytes(row["data"])
+        if row["redelivered"]:
+            message["redelivered"] = True
+        return message
+
+    def _enqueue(self, cursor, connection, topic: str, message: dict) -> int:
+        now = datetime.now()
+        expires_at = now + timedelta(seconds=_ttl(message))
+        #publishers to the same device take turns on its device_queues row until commit. Locking the newest
+        #command instead only takes a gap lock when the queue is empty, which two publishers can both hold
+        #before deadlocking on their INSERTs
+        cursor.execute("INSERT INTO device_queues (topic) VALUES (%s) ON DUPLICATE KEY UPDATE topic = topic", (topic,))
+        cursor.execute("DELETE FROM device_commands WHERE topic = %s AND expires_at <= %s", (topic, now))
+        #a locking read, so a consumer claiming this row right now is waited for rather than merged into
+        cursor.execute(
+            "SELECT id, payload, delivered_at, redelivered FROM device_commands WHERE topic = %s ORDER BY id DESC LIMIT 1 FOR UPDATE",
+            (topic,),
+        )
+        last = cursor.fetchone()
+        if last is not None and last["delivered_at"] is None and not last["redelivered"]:
+            merged = json.loads(last["payload"])
+            if _merge(merged, message):
+                cursor.execute(
+                    "UPDATE device_commands SET payload = %s, expires_at = %s WHERE id = %s",
+                    (json.dumps(merged), expires_at, last["id"]),
+                )
+                return last["id"]
+
+        cursor.execute("SELECT COUNT(*) AS pending FROM device_commands WHERE topic = %s", (topic,))
+        if cursor.fetchone()["pending"] >= self.maxsize:
+            for kind in DROPPABLE_KINDS:
+                cursor.execute(
+                    "DELETE FROM device_commands WHERE topic = %s AND kind = %s AND delivered_at IS NULL ORDER BY id LIMIT 1",
+                    (topic, kind),
+                )
+                if cursor.rowcount:
+                    logger.info(f"Dropped queued {kind} message, device queue full")
+                    break
+            else:
+                raise QueueFull()
+
+        payload, data = self._encode(message)
+        cursor.execute(
+            "INSERT INTO device_commands (topic, kind, payload, data, expires_at) VALUES (%s, %s, %s, %s, %s)",
+            (topic, message["type"], payload, data, expires_at),
+        )
+        return cursor.lastrowid
+
+    def _claim(self, cursor, connection, topic: str, kinds: Optional[tuple]) -> Optional[dict]:
+        now = datetime.now()
+        query = (
+            "SELECT id, kind, payload, data, expires_at, redelivered FROM device_commands"
+            " WHERE topic = %s AND delivered_at IS NULL AND expires_at > %s"
+        )
+        params = (topic, now)
+        if kinds is not None:
+            query += f" AND kind IN ({', '.join(['%s'] * len(kinds))})"
+            params += kinds
+        cursor.execute(query + " ORDER BY id LIMIT 1 FOR UPDATE SKIP LOCKED", params)
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        cursor.execute("UPDATE device_commands SET delivered_at = %s WHERE id = %s", (now, row["id"]))
+        return self._decode(row)
+
+    async def publish(self, topic: str, message: dict) -> int:
+        message_id = await database.run_db(self._enqueue, topic, message)
+        self._wakeup(topic).set()
+        return message_id
+
+    async def _claim_next(self, topic: str, kinds: Optional[tuple]) -> Optional[dict]:
+        claim = asyncio.ensure_future(database.run_db(self._claim, topic, kinds))
+        try:
+            return await asyncio.shield(claim)
+        except asyncio.CancelledError:
+            #the executor thread carries on regardless; give back whatever it claims
+            def release(done: asyncio.Future):
+                if not done.cancelled() and done.exception() is None and done.result() is not None:
+                    asyncio.ensure_future(self.release(topic, [done.result()["id"]]))
+            claim.add_done_callback(release)
+            raise
+
+    async def next(self, topic: str, kinds: Optional[Iterable[str]] = None) -> dict:
+        kinds = tuple(kinds) if kinds is not None else None
+        wakeup = self._wakeup(topic)
+        while True:
+            #cleared before looking, so a publish that lands meanwhile is not missed
+            wakeup.clear()
+            message = await self._claim_next(topic, kinds)
+            if message is not None:
+                return message
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def ack(self, topic: str, message_id: int):
+        await database.execute("DELETE FROM device_commands WHERE id = %s AND topic = %s", (message_id, topic))
+
+    async def release(self, topic: str, message_ids: Iterable[int]):
+        message_ids = list(message_ids)
+        if not message_ids:
+            return
+        placeholders = ", ".join(["%s"] * len(message_ids))
+        await database.execute(
+            f"UPDATE device_commands SET delivered_at = NULL, redelivered = TRUE WHERE topic = %s AND id IN ({placeholders})",
+            (topic, *message_ids),
+        )
+        self._wakeup(topic).set()
+
+    async def ack_through(self, topic: str, last_id: int):
+        await database.execute(
+            f"DELETE FROM device_commands WHERE topic = %s AND id <= %s AND kind IN ({', '.join(['%s'] * len(ACKED_KINDS))})",
+            (topic, last_id, *ACKED_KINDS),
+        )
+
+    async def redeliver(self, topic: str):
+        await database.execute(
+            "UPDATE device_commands SET delivered_at = NULL, redelivered = TRUE WHERE topic = %s AND delivered_at IS NOT NULL",
+            (topic,),
+        )
+        self._wakeup(topic).set()
+
+    async def discard_stream(self, topic: str, stream_id: int) -> int:
+        return await database.execute(
+            "DELETE FROM device_commands WHERE topic = %s AND kind = 'audio' AND delivered_at IS NULL"
+            " AND JSON_EXTRACT(payload, '$.stream') = %s",
+            (topic, stream_id),
+        )
+
+    async def depths(self) -> Dict[str, int]:
+        rows = await database.fetch_all("SELECT topic, COUNT(*) AS pending FROM device_commands GROUP BY topic")
+        return {row["topic"]: row["pending"] for row in rows}
+
+
+class Consumer:
+    """
+    One websocket's claims on a device queue.
+
+    Call sent() once a message from next() is on the socket, ack() when the
+    device confirms one of acked_kinds, and close() when the socket goes
+    away: anything it claimed but never sent, or sent but never had
+    confirmed, goes back to the front of the queue for the next connection.
+    """
+
+    def __init__(self, broker: CommandBroker, topic: str, kinds: Optional[Iterable[str]] = None, acked_kinds: Iterable[str] = ()):
+        self.broker = broker
+        self.topic = topic
+        self.kinds = kinds
+        self.acked_kinds = tuple(acked_kinds)
+        self.claimed = set()
+
+    async def next(self) -> dict:
+        message = await self.broker.next(self.topic, self.kinds)
+        self.claimed.add(message["id"])
+        return message
+
+    async def sent(self, message: dict):
+        #kinds the device confirms stay claimed until it acks them, the rest are done
+        if message["type"] not in self.acked_kinds:
+            self.claimed.discard(message["id"])
+            await self.broker.ack(self.topic, message["id"])
+
+    async def ack(self, message_id: int):
+        self.claimed.discard(message_id)
+        await self.broker.ack(self.topic, message_id)
+
+    async def close(self):
+        claimed, self.claimed = self.claimed, set()
+        if claimed:
+            await self.broker.release(self.topic, claimed)
+
+
+def create_broker(name: str) -> CommandBroker:
+    if name == "memory":
+        return InMemoryBroker(COMMAND_QUEUE_SIZE)
+    if name == "mysql":
+        return MySQLBroker(COMMAND_QUEUE_SIZE, COMMAND_POLL_INTERVAL)
+    raise RuntimeError(f"Unknown COMMAND_BROKER {name}")
+
+
+command_broker = create_broker(COMMAND_BROKER)
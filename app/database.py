@@ -6,9 +6,18 @@ import datetime
 from dotenv import load_dotenv
 import time
 import logging
+import asyncio
+import functools
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 #import mysql.connector
-from typing import Optional
-from mysql.connector import Error
+from typing import Callable, Optional
+from mysql.connector import Error, InterfaceError, OperationalError
+
+from app import metrics
+from app.migrations import apply_migrations
+from app.passwords import new_device_key
 
 
 # Load environment variables
@@ -19,103 +28,248 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def connectdb():
+POOL_SIZE = int(os.getenv("MYSQL_POOL_SIZE", 5))
+POOL_TIMEOUT = float(os.getenv("MYSQL_POOL_TIMEOUT", 10))          #seconds to wait for a free connection
+POOL_PING_INTERVAL = float(os.getenv("MYSQL_POOL_PING_INTERVAL", 30))  #ping connections idle longer than this
+POOL_RECYCLE = float(os.getenv("MYSQL_POOL_RECYCLE", 3600))        #reopen connections older than this
+
+DB_CALLS = metrics.Counter("petpal_db_calls_total", "Calls to database helpers", ("helper", "outcome"))
+DB_SECONDS = metrics.Histogram(
+    "petpal_db_call_seconds", "Time in database helpers, including the wait for a pooled connection", ("helper",)
+)
 
-    # Read Database connection variables
 
+def open_connection():
+    """Open a raw MySQL connection from the environment settings."""
+    # Read Database connection variables
     db_host = os.environ['MYSQL_HOST']
     db_user = os.environ['MYSQL_USER']
     db_pass = os.environ['MYSQL_PASSWORD']
     db_name = os.environ['MYSQL_DATABASE']
-    db = mysql.connect(user=db_user, password=db_pass, host=db_host, database=db_name,port = int(os.getenv('MYSQL_PORT', 3306)))
+    ssl_ca = os.getenv('MYSQL_SSL_CA')  # Path to CA certificate file, set this when deploying on render
+
+    options = {}
+    if ssl_ca:
+        options = {"ssl_ca": ssl_ca, "ssl_verify_identity": True}
+
+    return mysql.connect(user=db_user, password=db_pass, host=db_host, database=db_name,
+                         port=int(os.getenv('MYSQL_PORT', 3306)), **options)
+
+
+def connectdb():
+    """Open a standalone connection and dictionary cursor (outside the pool)."""
+    db = open_connection()
     cursor = db.cursor(dictionary=True)
     return cursor, db
 
 
+class PoolTimeout(Exception):
+    """Raised when no pooled connection frees up within POOL_TIMEOUT."""
 
-# def connectdb():
-#     # Read Database connection variables
-#     db_host = os.environ['MYSQL_HOST']
-#     db_user = os.environ['MYSQL_USER']
-#     db_pass = os.environ['MYSQL_PASSWORD']
-#     db_name = os.environ['MYSQL_DATABASE']
-#     ssl_ca  = os.getenv('MYSQL_SSL_CA')  # Path to CA certificate file
-    
 
-#     db = mysql.connect(user=db_user, 
-#                        port=int(os.getenv('MYSQL_PORT')),
-#                        password=db_pass, 
-#                        host=db_host, 
-#                        database=db_name,
-#                        ssl_ca=ssl_ca,
-#                        ssl_verify_identity=True
-#                        )
+class _PoolEntry:
+    __slots__ = ("connection", "created", "last_used")
 
-#     cursor = db.cursor(dictionary=True)
-#     return cursor, db
+    def __init__(self, connection):
+        self.connection = connection
+        self.created = time.monotonic()
+        self.last_used = self.created
 
 
+class ConnectionPool:
+    """
+    Bounded pool of mysql.connector connections.
 
-async def setup_database(initial_users: dict = None):
-    """Creates user, session, and new device-related tables, and populates initial user data if provided."""
-    connection = None
-    cursor = None
+    Connections are checked out from executor threads only, never from the event loop.
+    Idle connections are pinged before reuse, old ones are recycled, and any connection
+    that raised a connection-level error is closed instead of being returned.
+    """
+
+    def __init__(self, size: int, timeout: float, ping_interval: float, recycle: float):
+        self.size = size
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+        self.recycle = recycle
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._closed = False
+
+    def acquire(self) -> _PoolEntry:
+        if self._closed:
+            raise PoolTimeout("Connection pool is closed")
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolTimeout(f"No database connection available after {self.timeout}s")
+        try:
+            return self._checkout()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def _checkout(self) -> _PoolEntry:
+        while True:
+            try:
+                entry = self._idle.get_nowait()
+            except queue.Empty:
+                return _PoolEntry(open_connection())
+
+            now = time.monotonic()
+            if now - entry.created > self.recycle:
+                self._discard(entry)
+                continue
+            if now - entry.last_used > self.ping_interval:
+                try:
+                    entry.connection.ping(reconnect=False)
+                except Error:
+                    logger.info("Dropping stale pooled connection")
+                    self._discard(entry)
+                    continue
+            return entry
+
+    def release(self, entry: _PoolEntry, broken: bool = False):
+        try:
+            if broken or self._closed:
+                self._discard(entry)
+            else:
+                entry.last_used = time.monotonic()
+                self._idle.put(entry)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+    @staticmethod
+    def _discard(entry: _PoolEntry):
+        try:
+            entry.connection.close()
+        except Error:
+            pass
+
+
+_pool: Optional[ConnectionPool] = None
+_executor: Optional[ThreadPoolExecutor] = None
 
-    #table schemas
-    table_schemas = {
-        "users": """
-            CREATE TABLE IF NOT EXISTS users (
-                id INT AUTO_INCREMENT PRIMARY KEY,
-                name VARCHAR(255) NOT NULL,
-                email VARCHAR(255) NOT NULL UNIQUE,
-                password VARCHAR(255) NOT NULL,
-                location VARCHAR(255) NOT NULL
-            )
-        """,
-        "sessions": """
-            CREATE TABLE IF NOT EXISTS sessions (
-                id VARCHAR(36) PRIMARY KEY,
-                user_id INT NOT NULL,
-                start_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
-            )
-        """,
-        "user_devices": """
-            CREATE TABLE IF NOT EXISTS user_devices (
-                id INT AUTO_INCREMENT PRIMARY KEY,
-                user_id INT NOT NULL,
-                device_topic VARCHAR(255) NOT NULL UNIQUE,
-                FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
-            )
-        """,
-        
-    }
 
+def _ensure_pool() -> ConnectionPool:
+    global _pool, _executor
+    if _pool is None:
+        _pool = ConnectionPool(POOL_SIZE, POOL_TIMEOUT, POOL_PING_INTERVAL, POOL_RECYCLE)
+        #one thread per connection, so a thread never sits waiting on the pool
+        _executor = ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix="db")
+    return _pool
+
+
+def _run_sync(fn: Callable, args: tuple, dictionary: bool):
+    pool = _ensure_pool()
+    entry = pool.acquire()
+    broken = False
+    cursor = None
     try:
-        #database connection
-        cursor, connection = connectdb()  #unpack tuple
-
-        
-        #drop and recreate tables one by one  (U_DEVS AND WARDROBE NOT BEING CREATED)
-        # for table_name in ["sensor_data","user_devices","sessions", "wardrobe", "sensor_temp","users"]:
-        #     #drop table if exists
-        #     logger.info(f"Dropping table {table_name} if exists...")
-        #     cursor.execute(f"DROP TABLE IF EXISTS {table_name}")
-        #     connection.commit()
-        
-        #recreate tables
-        for table_name, create_query in table_schemas.items():
+        #buffered so an unread row never leaves the pooled connection in a bad state
+        cursor = entry.connection.cursor(dictionary=dictionary, buffered=True)
+        result = fn(cursor, entry.connection, *args)
+        #always end the transaction so the next user of this connection gets a fresh snapshot
+        entry.connection.commit()
+        return result
+    except (InterfaceError, OperationalError):
+        broken = True
+        raise
+    except Exception:
+        try:
+            entry.connection.rollback()
+        except Error:
+            broken = True
+        raise
+    finally:
+        if cursor is not None:
             try:
-                #create table
-                logger.info(f"Creating table {table_name}...")
-                cursor.execute(create_query)
-                connection.commit()
-                logger.info(f"Table {table_name} created successfully")
-            except Error as e:
-                logger.error(f"Error creating table {table_name}: {e}")
-                raise
-                
+                cursor.close()
+            except Error:
+                broken = True
+        pool.release(entry, broken)
+
+
+async def run_db(fn: Callable, *args, dictionary: bool = True):
+    """
+    Run fn(cursor, connection, *args) on a pooled connection in the database executor.
+
+    The transaction is committed when fn returns and rolled back if it raises.
+    """
+    _ensure_pool()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(_run_sync, fn, args, dictionary))
+
+
+async def fetch_one(query: str, params: tuple = ()) -> Optional[dict]:
+    """Run a query and return its first row."""
+    def _fetch(cursor, connection):
+        cursor.execute(query, params)
+        return cursor.fetchone()
+    return await run_db(_fetch)
+
+
+async def fetch_all(query: str, params: tuple = ()) -> list:
+    """Run a query and return all rows."""
+    def _fetch(cursor, connection):
+        cursor.execute(query, params)
+        return cursor.fetchall()
+    return await run_db(_fetch)
+
+
+async def execute(query: str, params: tuple = ()) -> int:
+    """Run a write statement and return the affected row count."""
+    def _execute(cursor, connection):
+        cursor.execute(query, params)
+        return cursor.rowcount
+    return await run_db(_execute)
+
+
+async def init_pool():
+    """Create the pool and open one connection so bad settings fail at startup."""
+    _ensure_pool()
+    await fetch_one("SELECT 1")
+    logger.info(f"Database pool ready (size={POOL_SIZE})")
+
+
+async def close_pool():
+    """Close idle connections and stop the database executor."""
+    global _pool, _executor
+    pool, executor = _pool, _executor
+    _pool, _executor = None, None
+    if executor is not None:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, functools.partial(executor.shutdown, wait=True))
+    if pool is not None:
+        pool.close()
+        logger.info("Database pool closed")
+
+
+
+def instrumented(fn: Callable) -> Callable:
+    """Count calls to a helper and time them, labelled with its name."""
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            result = await fn(*args, **kwargs)
+            outcome = "ok"
+            return result
+        finally:
+            DB_SECONDS.observe(time.perf_counter() - started, fn.__name__)
+            DB_CALLS.inc(fn.__name__, outcome)
+    return wrapper
+
+
+async def setup_database(initial_users: dict = None):
+    """Migrates the schema to the latest version, and populates initial user data if provided."""
+    def _setup(cursor, connection):
+        apply_migrations(cursor, connection)
 
         #Insert initial users if provided
         if initial_users:
@@ -129,52 +283,28 @@ async def setup_database(initial_users: dict = None):
                 logger.error(f"Error inserting initial users: {e}")
                 raise
 
+    try:
+        await run_db(_setup)
     except Exception as e:
         logger.error(f"Database setup failed: {e}")
         raise
 
-    finally:
-        if cursor:
-            cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
-            logger.info("Database connection closed")
-
 
 
+@instrumented
 async def get_user_by_email(email: str) -> Optional[dict]:
     """Retrieve user from database by email."""
-    connection = None
-    cursor = None
-    try:
-        cursor, connection = connectdb()  
-        cursor.execute("SELECT * FROM users WHERE email = %s", (email,))
-        return cursor.fetchone()
-    finally:
-        if cursor:
-            cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
+    return await fetch_one("SELECT * FROM users WHERE email = %s", (email,))
 
 
 # Database utility functions for user and session management
+@instrumented
 async def get_user_by_name(name: str) -> Optional[dict]:
     """Retrieve user from database by name."""
-    connection = None
-    cursor = None
-    try:
-        #connection = get_db_connection()
-        cursor, connection = connectdb()  # Unpack the returned tuple here
-        cursor = connection.cursor(dictionary=True)
-        cursor.execute("SELECT * FROM users WHERE name = %s", (name,))
-        return cursor.fetchone()
-    finally:
-        if cursor:
-            cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
+    return await fetch_one("SELECT * FROM users WHERE name = %s", (name,))
 
 
+@instrumented
 async def get_user_by_id(user_id: int) -> Optional[dict]:
     """
     Retrieve user from database by ID.
@@ -185,97 +315,220 @@ async def get_user_by_id(user_id: int) -> Optional[dict]:
     Returns:
         Optional[dict]: User data if found, None otherwise
     """
-    connection = None
-    cursor = None
-    try:
-        #connection = get_db_connection()
-        cursor, connection = connectdb()  # Unpack the returned tuple here
-        cursor = connection.cursor(dictionary=True)
-        cursor.execute("SELECT * FROM users WHERE id = %s", (user_id,))
-        return cursor.fetchone()
-    finally:
-        if cursor:
-            cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
+    return await fetch_one("SELECT * FROM users WHERE id = %s", (user_id,))
 
 
-async def create_session(user_id: int, session_id: str) -> bool:
-    """Create a new session in the database."""
-    connection = None
-    cursor = None
-    try:
-        #connection = get_db_connection()
-        cursor, connection = connectdb()  # Unpack the returned tuple here
-        cursor = connection.cursor()
+@instrumented
+async def get_user_profile(user_id: int) -> Optional[dict]:
+    """The user's id, name, email and location; everything but the password hash."""
+    return await fetch_one("SELECT id, name, email, location FROM users WHERE id = %s", (user_id,))
+
+
+@instrumented
+async def create_user(name: str, email: str, password: str, location: Optional[str]) -> int:
+    """Insert a new user and return its ID."""
+    def _insert(cursor, connection):
         cursor.execute(
-            "INSERT INTO sessions (id, user_id) VALUES (%s, %s)", (session_id, user_id)
+            "INSERT INTO users (name, email, password, location) VALUES (%s, %s, %s, %s)",
+            (name, email, password, location),
         )
-        connection.commit()
-        return True
-    finally:
-        if cursor:
-            cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
+        return cursor.lastrowid
+    return await run_db(_insert)
+
 
+@instrumented
+async def update_user_password(user_id: int, password: str):
+    """Replace a user's stored password hash."""
+    await execute("UPDATE users SET password = %s WHERE id = %s", (password, user_id))
 
+
+@instrumented
+async def create_session(user_id: int, session_id: str) -> bool:
+    """Create a new session in the database."""
+    await execute(
+        "INSERT INTO sessions (id, user_id) VALUES (%s, %s)", (session_id, user_id)
+    )
+    return True
+
+
+@instrumented
 async def get_session(session_id: str) -> Optional[dict]:
     """Retrieve session from database."""
-    connection = None
-    cursor = None
-    try:
-        #connection = get_db_connection()
-        cursor, connection = connectdb()  # Unpack the returned tuple here
-        cursor = connection.cursor(dictionary=True)
-        cursor.execute(
-            """
-            SELECT *
-            FROM sessions s
-            WHERE s.id = %s
-        """,
-            (session_id,),
+    return await fetch_one(
+        """
+        SELECT *
+        FROM sessions s
+        WHERE s.id = %s
+    """,
+        (session_id,),
+    )
+
+
+@instrumented
+async def get_session_with_user(session_id: str) -> Optional[dict]:
+    """Retrieve a session and its user in one query; the user is returned under "user"."""
+    row = await fetch_one(
+        """
+        SELECT s.id, s.user_id, s.start_time, s.last_active,
+               u.name, u.email, u.location
+        FROM sessions s
+        JOIN users u ON u.id = s.user_id
+        WHERE s.id = %s
+    """,
+        (session_id,),
+    )
+    if row is None:
+        return None
+    user = {"id": row["user_id"]}
+    for column in ("name", "email", "location"):
+        user[column] = row.pop(column)
+    row["user"] = user
+    return row
+
+
+@instrumented
+async def touch_sessions(touches: list):
+    """Write a batch of (session_id, last_active) pairs, never moving last_active backwards."""
+    def _touch(cursor, connection):
+        cursor.executemany(
+            "UPDATE sessions SET last_active = %s WHERE id = %s AND last_active < %s",
+            [(last_active, session_id, last_active) for session_id, last_active in touches],
         )
-        return cursor.fetchone()
-    finally:
-        if cursor:
-            cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
+    await run_db(_touch)
 
 
+@instrumented
 async def delete_session(session_id: str) -> bool:
     """Delete a session from the database."""
-    connection = None
-    cursor = None
-    try:
-        #connection = get_db_connection()
-        cursor, connection = connectdb()  # Unpack the returned tuple here
-        cursor = connection.cursor()
-        cursor.execute("DELETE FROM sessions WHERE id = %s", (session_id,))
-        connection.commit()
-        return True
-    finally:
-        if cursor:
-            cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
+    await execute("DELETE FROM sessions WHERE id = %s", (session_id,))
+    return True
 
 
-#use in profile tab later
+@instrumented
+async def revoke_session(session_id: str, expires_at: datetime.datetime):
+    """Add a session to the shared revocation list, pruning entries that have lapsed."""
+    def _revoke(cursor, connection):
+        cursor.execute("DELETE FROM session_revocations WHERE expires_at < %s", (datetime.datetime.now(),))
+        cursor.execute(
+            "REPLACE INTO session_revocations (session_id, expires_at) VALUES (%s, %s)", (session_id, expires_at)
+        )
+    await run_db(_revoke)
+
+
+@instrumented
+async def get_session_revocations(now: datetime.datetime) -> list:
+    """Return (session_id, expires_at) for revocations still in force."""
+    rows = await fetch_all("SELECT session_id, expires_at FROM session_revocations WHERE expires_at >= %s", (now,))
+    return [(row["session_id"], row["expires_at"]) for row in rows]
 
-async def add_user_device(user_id: int, device_topic: str):
-    """Associates a user with a device by adding a record in the user_device table."""
-    connection = None
-    cursor = None
-    try:
-        cursor, connection = connectdb()  # Unpack the returned tuple here
-        cursor.execute("INSERT INTO user_devices (user_id, device_id) VALUES (%s, %s)", (user_id, device_topic))
-        connection.commit()
-        logger.info(f"User with ID {user_id} associated with device topic {device_topic}")
-    finally:
-        if cursor:
-            cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
 
+@instrumented
+async def delete_expired_sessions(cutoff: datetime.datetime, batch_size: int, pause: float, lock_name: str) -> Optional[int]:
+    """
+    Delete sessions idle since before cutoff in batches of batch_size, sleeping
+    pause seconds between batches so each DELETE only holds its locks briefly.
+
+    Runs only while holding the advisory lock lock_name, so a single worker
+    does it at a time. Returns the number of rows removed, or None if another
+    worker holds the lock.
+    """
+    def _reap(cursor, connection):
+        cursor.execute("SELECT GET_LOCK(%s, 0) AS locked", (lock_name,))
+        if not cursor.fetchone()["locked"]:
+            return None
+        try:
+            total = 0
+            while True:
+                cursor.execute(
+                    "DELETE FROM sessions WHERE last_active < %s ORDER BY last_active LIMIT %s",
+                    (cutoff, batch_size),
+                )
+                deleted = cursor.rowcount
+                connection.commit()
+                total += deleted
+                if deleted < batch_size:
+                    return total
+                time.sleep(pause)  #executor thread, not the event loop
+        finally:
+            cursor.execute("SELECT RELEASE_LOCK(%s)", (lock_name,))
+            cursor.fetchall()
+    return await run_db(_reap)
+
+
+#use in profile tab later
+
+@instrumented
+async def add_user_device(user_id: int, device_topic: str) -> str:
+    """Associates a user with a device and returns the new device's key, which is only stored hashed."""
+    key, key_hash = new_device_key()
+    await execute(
+        "INSERT INTO user_devices (user_id, device_topic, device_key_hash) VALUES (%s, %s, %s)",
+        (user_id, device_topic, key_hash),
+    )
+    logger.info(f"User with ID {user_id} associated with device topic {device_topic}")
+    return key
+
+
+@instrumented
+async def set_device_key(device_topic: str) -> Optional[str]:
+    """Give a registered device a new key, replacing any old one; None if the topic isn't registered."""
+    key, key_hash = new_device_key()
+    updated = await execute("UPDATE user_devices SET device_key_hash = %s WHERE device_topic = %s", (key_hash, device_topic))
+    if not updated:
+        #MySQL counts only changed rows, and a fresh key always changes it
+        return None
+    logger.info(f"Issued a new key for device topic {device_topic}")
+    return key
+
+
+@instrumented
+async def get_device_key_hash(device_topic: str) -> Optional[str]:
+    """The stored key hash for a device topic, None if it is unregistered or has no key."""
+    row = await fetch_one("SELECT device_key_hash FROM user_devices WHERE device_topic = %s", (device_topic,))
+    return row["device_key_hash"] if row else None
+
+
+@instrumented
+async def get_user_devices(user_id: int) -> list:
+    """Return the device topics registered to a user, oldest first."""
+    rows = await fetch_all("SELECT device_topic FROM user_devices WHERE user_id = %s ORDER BY id", (user_id,))
+    return [row["device_topic"] for row in rows]
+
+
+@instrumented
+async def insert_sensor_readings(rows: list, rollups: list = ()):
+    """
+    Insert a batch of (topic, temp, timestamp) rows in one multi-row INSERT, and
+    merge the matching (topic, resolution, bucket_start, min, max, sum, count)
+    rollups in the same transaction.
+    """
+    def _insert(cursor, connection):
+        cursor.executemany("INSERT INTO sensor_data (topic, temp, timestamp) VALUES (%s, %s, %s)", rows)
+        if rollups:
+            cursor.executemany(
+                """
+                INSERT INTO sensor_rollups (topic, resolution, bucket_start, min_temp, max_temp, sum_temp, count)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                ON DUPLICATE KEY UPDATE
+                    min_temp = LEAST(min_temp, VALUES(min_temp)),
+                    max_temp = GREATEST(max_temp, VALUES(max_temp)),
+                    sum_temp = sum_temp + VALUES(sum_temp),
+                    count = count + VALUES(count)
+                """,
+                rollups,
+            )
+    await run_db(_insert, dictionary=False)
+
+
+@instrumented
+async def get_sensor_rollups(topic: str, resolution: int, start: datetime.datetime, end: datetime.datetime) -> list:
+    """Rollup buckets for a topic at one resolution, oldest first."""
+    return await fetch_all(
+        """
+        SELECT bucket_start, min_temp, max_temp, sum_temp / count AS avg_temp, count
+        FROM sensor_rollups
+        WHERE topic = %s AND resolution = %s AND bucket_start >= %s AND bucket_start < %s
+        ORDER BY bucket_start
+        """,
+        (topic, resolution, start, end),
+    )
@@ -0,0 +1,54 @@
+"""
+Register a dispenser to a user, or give a registered one a new key.
+
+    python -m app.devices add <user email> <device topic>
+    python -m app.devices rotate <device topic>
+
+Both print the device's key once, to put in PETPAL_DEVICE_KEY on the pi;
+only its hash is stored. A rotated key takes effect on the device's next
+connection. Uses the same MYSQL_* settings as the server and migrates the
+schema first.
+"""
+import argparse
+import asyncio
+import sys
+
+from mysql.connector import IntegrityError
+
+from app.database import add_user_device, close_pool, get_user_by_email, set_device_key, setup_database
+
+
+async def main(args) -> int:
+    await setup_database()
+    try:
+        if args.command == "add":
+            user = await get_user_by_email(args.email)
+            if user is None:
+                print(f"No user with email {args.email}")
+                return 1
+            try:
+                key = await add_user_device(user["id"], args.topic)
+            except IntegrityError:
+                print(f"Device topic {args.topic} is already registered, use rotate for a new key")
+                return 1
+        else:
+            key = await set_device_key(args.topic)
+            if key is None:
+                print(f"Device topic {args.topic} is not registered, use add first")
+                return 1
+    finally:
+        await close_pool()
+    print(f"PETPAL_DEVICE={args.topic}")
+    print(f"PETPAL_DEVICE_KEY={key}")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python -m app.devices", description="Register PetPal devices and issue their keys")
+    commands = parser.add_subparsers(dest="command", required=True)
+    add = commands.add_parser("add", help="register a device topic to a user and issue its key")
+    add.add_argument("email")
+    add.add_argument("topic")
+    rotate = commands.add_parser("rotate", help="issue a new key for a registered device")
+    rotate.add_argument("topic")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,90 @@
+import asyncio
+import logging
+import os
+from typing import List, Tuple
+
+from app import database
+from app.rollups import aggregate
+
+
+logger = logging.getLogger(__name__)
+
+SENSOR_BATCH_SIZE = int(os.getenv("SENSOR_BATCH_SIZE", 500))            #rows per INSERT, and the size that triggers a flush
+SENSOR_FLUSH_INTERVAL = float(os.getenv("SENSOR_FLUSH_INTERVAL", 1.0))  #seconds before a partial batch is written anyway
+SENSOR_MAX_BUFFERED = int(os.getenv("SENSOR_MAX_BUFFERED", 20000))      #readings held in memory before refusing more
+
+
+class IngestBusy(Exception):
+    """Raised when the buffer is full because the database is falling behind."""
+
+
+class SensorIngestor:
+    """
+    Buffers sensor readings in memory and writes them with multi-row inserts.
+
+    Every flush also folds the batch into the per-topic minute/hour/day
+    rollups. A flush happens whenever SENSOR_BATCH_SIZE readings are waiting or
+    SENSOR_FLUSH_INTERVAL has passed. Readings that fail to insert go back to
+    the front of the buffer; once the buffer is full new readings are refused
+    with IngestBusy so callers can back off.
+    """
+
+    def __init__(self, batch_size: int, flush_interval: float, max_buffered: int):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered
+        self._buffer: List[Tuple] = []
+        self._in_flight = 0
+        self._wake = None  #created by run() inside the running loop
+        self._lock = None
+
+    @property
+    def buffered(self) -> int:
+        return len(self._buffer) + self._in_flight
+
+    def add(self, rows: List[Tuple]):
+        """Queue (topic, temp, timestamp) rows for the next flush."""
+        if self.buffered + len(rows) > self.max_buffered:
+            raise IngestBusy()
+        self._buffer.extend(rows)
+        if len(self._buffer) >= self.batch_size and self._wake is not None:
+            self._wake.set()
+
+    async def flush(self) -> int:
+        """Write everything buffered so far, one batch at a time."""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        written = 0
+        async with self._lock:
+            while self._buffer:
+                batch = self._buffer[:self.batch_size]
+                del self._buffer[:self.batch_size]
+                self._in_flight = len(batch)
+                try:
+                    #grouping is vectorized and cheap, but still kept off the event loop
+                    rollups = await asyncio.get_running_loop().run_in_executor(None, aggregate, batch)
+                    await database.insert_sensor_readings(batch, rollups)
+                except Exception:
+                    self._buffer[:0] = batch
+                    raise
+                finally:
+                    self._in_flight = 0
+                written += len(batch)
+        return written
+
+    async def run(self):
+        """Flush on size or time until cancelled."""
+        self._wake = asyncio.Event()
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Writing sensor readings failed, {len(self._buffer)} buffered: {e}")
+
+
+sensor_ingestor = SensorIngestor(SENSOR_BATCH_SIZE, SENSOR_FLUSH_INTERVAL, SENSOR_MAX_BUFFERED)
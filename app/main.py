@@ -1,36 +1,37 @@
-from fastapi import FastAPI, Request, Form, Query,status, HTTPException, Body, WebSocket, WebSocketDisconnect, UploadFile, File
+from fastapi import FastAPI, Request, Form, Query,status, HTTPException, Body, Depends, WebSocket, UploadFile, File
 from fastapi.responses import Response, RedirectResponse
-from fastapi.responses import HTMLResponse, JSONResponse
-from fastapi.staticfiles import StaticFiles   # Used for serving static files
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse
+from starlette.datastructures import MutableHeaders
+from starlette.requests import HTTPConnection
 import uvicorn
 import os
 import base64
 from pydantic import BaseModel, EmailStr
 import json
-from typing import Optional
+from typing import List, Optional
 import mysql.connector as mysql
 from dotenv import load_dotenv
 import datetime
-import uuid
 from typing import Dict
 from contextlib import asynccontextmanager
-import hashlib
+from http.cookies import SimpleCookie
 from datetime import datetime, timedelta
 import asyncio
+import itertools
+import time
 import requests
 from fastapi.middleware.cors import CORSMiddleware
 
 
 load_dotenv()
 
-SYSTEM_SALT = b"my-fixed-salt-12345"
-motor_queue = []
-audio_out_queue = []
-cam_queue = []
 
-
-#change number value for different time-out time in minutes
-SESSION_TIMEOUT = timedelta(minutes=int(os.getenv("SESSION_TIMEOUT_MINUTES", 5)))
+#ids for audio streams sent to devices, carried in the binary frame header
+audio_stream_ids = itertools.count(1)
+AUDIO_CHUNK_SIZE = int(os.getenv("AUDIO_CHUNK_SIZE", 32 * 1024))  #bytes per audio frame forwarded to a device
+AUDIO_QUEUE_WAIT = float(os.getenv("AUDIO_QUEUE_WAIT", 10))  #seconds an audio frame waits for room in a full device queue
+AUDIO_QUEUE_RETRY = 0.05
+DEVICE_AUTH_TIMEOUT = float(os.getenv("DEVICE_AUTH_TIMEOUT", 10))  #seconds a device socket has to send its key
 
 
 
@@ -56,17 +57,31 @@ class LoginRequest(BaseModel):
 
 class MotorCommand(BaseModel):
     motor: int
+    device: Optional[str] = None
 
 from app.database import (
-    connectdb,
+    init_pool,
+    close_pool,
     setup_database,
     get_user_by_email,
     get_user_by_name,
-    get_user_by_id,
-    create_session,
-    get_session,
-    delete_session,
+    create_user,
+    update_user_password,
+    get_user_devices,
+    get_device_key_hash,
+    get_sensor_rollups,
 )
+from app.sessions import SESSION_TIMEOUT, session_backend
+from app.passwords import HasherBusy, device_key_matches, password_hasher
+from app.commands import ACKED_KINDS, DEFAULT_DEVICE_TOPIC, Consumer, QueueFull, command_broker
+from app.ingest import IngestBusy, sensor_ingestor
+from app.rollups import bucket_floor, naive_utc, pick_resolution
+from app.pubsub import sensor_hub, within
+from app.assets import CachedStaticFiles, asset_cache
+from app.protocol import FLAG_END, FLAG_START, KIND_AUDIO, KIND_VIDEO, PROTO_BINARY, PROTO_JSON, FrameError, decode_frame, encode_frame
+from app.video import video_relay
+from app.tracing import TRACE_BUFFER, command_tracer
+from app import metrics
 
 @asynccontextmanager
 async def setup(app: FastAPI):
@@ -77,16 +92,28 @@ async def setup(app: FastAPI):
     # Startup: Setup resources
     print("In Setup...")
     try:
+        await init_pool()
         # Make sure setup_database is async
         await setup_database()
         print("Database setup completed")
+        asset_cache.preload()
+        #session backend background work, e.g. flushing activity and deleting expired sessions
+        await session_backend.start()
+        await command_broker.start()
+        sensor_flusher = asyncio.create_task(sensor_ingestor.run())
         yield
+        sensor_flusher.cancel()
+        await command_broker.stop()
+        await session_backend.stop()
+        await sensor_ingestor.flush()
     finally:
+        password_hasher.close()
+        await close_pool()
         print("Shutdown completed")
  
 
 app = FastAPI(lifespan=setup)
-static_files = StaticFiles(directory='app/public')
+static_files = CachedStaticFiles(directory='app/public')
 app.mount('/public', static_files, name='public')
 
 app.add_middleware(
@@ -98,143 +125,533 @@ app.add_middleware(
 )
 
 
-#Update last time user was active, store in session database
-async def update_last_active(session_id: str):
-    cursor, db = connectdb()
-    cursor.execute("UPDATE sessions SET last_active = %s WHERE id = %s", (datetime.now(), session_id))
-    db.commit()
-    db.close()
+HTTP_SECONDS = metrics.Histogram("petpal_http_request_seconds", "HTTP request latency", ("method", "route", "status"))
+WS_CONNECTIONS = metrics.Gauge("petpal_ws_connections", "Open websocket connections", ("endpoint",))
+WS_SENT = metrics.Counter("petpal_ws_messages_sent_total", "Messages sent to websocket clients", ("endpoint", "kind"))
+
+#read when /metrics is scraped rather than updated on every change
+metrics.Collected("petpal_command_queue_depth", "Pending device commands", command_broker.depths, labelnames=("device",))
+metrics.Collected("petpal_password_hashes_pending", "PBKDF2 hashes running or queued", lambda: password_hasher.pending)
+metrics.Collected("petpal_sensor_readings_buffered", "Sensor readings waiting to be written", lambda: sensor_ingestor.buffered)
+metrics.Collected("petpal_sensor_subscribers", "Live sensor websocket subscriptions", sensor_hub.subscriber_count)
+_reaper = getattr(session_backend, "reaper", None)
+if _reaper is not None:
+    metrics.Collected("petpal_session_reaper_runs_total", "Expired-session sweeps run", lambda: _reaper.runs, kind="counter")
+    metrics.Collected("petpal_session_reaper_skipped_total", "Sweeps skipped because another worker held the lock", lambda: _reaper.skipped, kind="counter")
+    metrics.Collected("petpal_sessions_reaped_total", "Expired sessions deleted", lambda: _reaper.rows_reaped, kind="counter")
+    metrics.Collected("petpal_session_reaper_seconds_total", "Time spent sweeping", lambda: _reaper.seconds_spent, kind="counter")
+
+
+class RequestMetrics:
+    """
+    Time every request, labelled by route template so /user/{name} is one series.
+
+    A plain ASGI middleware rather than @app.middleware("http"), which runs
+    the rest of the app in a separate task and streams every response body
+    through a queue. Status comes from the response start message; a request
+    that raises before sending one is recorded as a 500.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        #wall clock, for tracing commands across workers and on to the device; read back as request.state.received_at
+        scope.setdefault("state", {})["received_at"] = time.time()
+        status_code = "500"
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = str(message["status"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            HTTP_SECONDS.observe(time.perf_counter() - started, scope["method"], getattr(route, "path", "other"), status_code)
+
+
+app.add_middleware(RequestMetrics)
+
+
+class SessionCookieRenewal:
+    """
+    Send the renewed session token back when validate_session reissued it.
+
+    Plain ASGI like RequestMetrics: the token is read from request.state,
+    which is scope["state"], as the response starts.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_cookie(message):
+            renewed = scope.get("state", {}).get("renewed_session")
+            if message["type"] == "http.response.start" and renewed:
+                cookie = SimpleCookie()
+                cookie["session_id"] = renewed
+                #what Response.set_cookie sends by default
+                cookie["session_id"]["path"] = "/"
+                cookie["session_id"]["samesite"] = "lax"
+                MutableHeaders(scope=message).append("set-cookie", cookie.output(header="").strip())
+            await send(message)
+
+        await self.app(scope, receive, send_with_cookie)
+
+
+app.add_middleware(SessionCookieRenewal)
+
+
+@app.exception_handler(HasherBusy)
+async def hasher_busy_handler(request: Request, exc: HasherBusy):
+    #too many logins/signups hashing at once, ask the client to back off
+    return JSONResponse({"detail": "Too many requests, try again shortly"}, status_code=429, headers={"Retry-After": "1"})
+
+
+@app.exception_handler(IngestBusy)
+async def ingest_busy_handler(request: Request, exc: IngestBusy):
+    #the database is behind on sensor writes, senders should retry later
+    return JSONResponse({"detail": "Sensor buffer full, try again shortly"}, status_code=503, headers={"Retry-After": "1"})
+
+
+async def authenticate(email: str, password: str) -> Optional[dict]:
+    """Return the user if the password matches, upgrading old hashes on the way."""
+    user = await get_user_by_email(email)
+    matches, needs_rehash = await password_hasher.verify(password, user["password"] if user else None)
+    if not matches:
+        return None
+    if needs_rehash:
+        await update_user_password(user["id"], await password_hasher.hash(password))
+    return user
+
 
 #if session expires
 async def is_session_expired(session: dict) -> bool:
     return datetime.now() > session["last_active"] + SESSION_TIMEOUT
 
 
-async def validate_session(request: Request):
+async def load_session(request: HTTPConnection) -> Optional[dict]:
+    """
+    Resolve the session cookie to a live session, with its user under "user".
+
+    The result is kept on request.state, so however many places ask during one
+    request the lookup (a single sessions JOIN users query on a cache miss) runs once.
+    """
+    if hasattr(request.state, "session"):
+        return request.state.session
+    request.state.session = None
+
     sessionId = request.cookies.get("session_id")
     if not sessionId:
-        return RedirectResponse(url="/login")  # Redirect if no session ID
+        return None
 
-    session = await get_session(sessionId)
+    session = await session_backend.get_session_user(sessionId)
 
     if not session:
-        return RedirectResponse(url="/login")  # Redirect if invalid session
+        return None
 
     if await is_session_expired(session):
-        await delete_session(sessionId)
-        return RedirectResponse(url="/login")  # Redirect if session expired
-
-    await update_last_active(sessionId) #update session active time
-
+        #the cached copy may be stale if another worker kept this session alive
+        session = await session_backend.get_session_user(sessionId, reload=True)
+        if not session or await is_session_expired(session):
+            await session_backend.delete_session(sessionId)
+            return None
+
+    #update session active time; token backends may hand back a renewed cookie
+    renewed = session_backend.touch_session(sessionId, session)
+    if renewed:
+        request.state.renewed_session = renewed
+
+    request.state.session = session
     return session
 
-#delete sessions that have expired
-async def cleanup_expired_sessions():
-    while True:
-        cursor, db = connectdb()
-        cursor.execute("DELETE FROM sessions WHERE last_active < %s", (datetime.now() - SESSION_TIMEOUT,))
-        db.commit()
-        db.close()
-        await asyncio.sleep(600)
 
-#delete all sessions that are still open but expired, on start up
-@app.on_event("startup")
-async def startup_event():
-    asyncio.create_task(cleanup_expired_sessions())
+async def validate_session(request: HTTPConnection):
+    """Route dependency: the session, or a redirect to /login if there is no valid one."""
+    session = await load_session(request)
+    if not session:
+        return RedirectResponse(url="/login")  # Redirect if no, invalid or expired session
+    return session
 
+async def resolve_device(request: Request, device: Optional[str] = None) -> str:
+    """Pick which of the logged-in user's devices a command is for: the one named, else their first."""
+    session = await load_session(request)
+    if not session:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not logged in")
+    devices = await get_user_devices(session["user_id"])
+    if not device:
+        return devices[0] if devices else DEFAULT_DEVICE_TOPIC
+    if device not in devices:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Unknown device")
+    return device
+
+
+async def queue_command(topic: str, message: dict, ingress: Optional[float] = None) -> Optional[str]:
+    """Publish a command for a device; motor and camera commands get a trace, whose id is returned."""
+    trace_id = command_tracer.stamp(message, ingress)
+    try:
+        await command_broker.publish(topic, message)
+    except QueueFull:
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="Device has too many pending commands")
+    return trace_id
 
 
-# Static file helpers
-def read_html(file_path: str) -> str:
-    with open(file_path, "r") as f:
-        return f.read()
 
+# Static file helpers, pages come from the in-memory asset cache
 def get_error_html(name: str) -> str:
-    error_html = read_html("app/public/error.html")
-    return error_html.replace("{name}", name)
+    return asset_cache.template("error.html", ("name",)).render(name=name)
 
 def get_error_email(email: str) -> str:
-    error_html = read_html("app/public/error_email.html")
-    return error_html.replace("{email}", email)
+    return asset_cache.template("error_email.html", ("email",)).render(email=email)
 
 
 #main page route
 @app.get("/", response_class=HTMLResponse, include_in_schema=False)
-async def get_html() -> HTMLResponse:
-    with open("app/public/index.html") as html:
-        return HTMLResponse(content=html.read())
+async def get_html(request: Request) -> HTMLResponse:
+    return asset_cache.page(request, "index.html")
 
 
 @app.post("/api/motor")
-async def send_motor_command(cmd: MotorCommand):
-    motor_queue.append(cmd.motor)
-    return {"message": f"Motor {cmd.motor} command received"}
+async def send_motor_command(cmd: MotorCommand, request: Request):
+    topic = await resolve_device(request, cmd.device)
+    trace_id = await queue_command(topic, {"type": "command", "motor": cmd.motor}, request.state.received_at)
+    return {"message": f"Motor {cmd.motor} command received", "trace_id": trace_id}
 
 
 @app.post("/api/sound")
-async def send_audio_command(request: Request, file: UploadFile = File(...)):
-    form = await request.form()
-    print("❗ request.form() =", form)  
-    # This should print something like: {'file': <UploadFile chunk.webm ...>} so make sure output is correct if no audio plays
-    contents = await file.read()
-    audio_out_queue.append(contents)
+async def send_audio_command(
+    request: Request,
+    file: UploadFile = File(...),
+    device: Optional[str] = None,
+    stream: Optional[int] = None,
+    seq: int = 0,
+    final: bool = True,
+):
+    """
+    Queue a recorded clip, or one chunk of a recording in progress.
+
+    Recorders that upload as they go pass the same stream id with an increasing
+    seq for every chunk and final=true on the last one; the device starts
+    playing on the first chunk.
+    """
+    topic = await resolve_device(request, device)
+    if stream is None:
+        stream_id, first = next(audio_stream_ids) & 0xFFFFFFFF, True
+    else:
+        stream_id, first = stream & 0xFFFFFFFF, seq == 0
+
+    async def chunks():
+        while True:
+            chunk = await file.read(AUDIO_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+    await forward_audio(topic, stream_id, chunks(), first, final)
+    return {"status": "queued"}
+
+
+@app.post("/api/sound/stream")
+async def stream_audio_command(request: Request, device: Optional[str] = None):
+    """Forward a raw audio request body to the device while it is still uploading."""
+    topic = await resolve_device(request, device)
+    stream_id = next(audio_stream_ids) & 0xFFFFFFFF
+    await forward_audio(topic, stream_id, request.stream(), True, True)
     return {"status": "queued"}
 
 
+async def queue_audio(topic: str, message: dict):
+    """Publish an audio frame, waiting up to AUDIO_QUEUE_WAIT for room since audio is never dropped to make some."""
+    deadline = time.monotonic() + AUDIO_QUEUE_WAIT
+    while True:
+        try:
+            await command_broker.publish(topic, message)
+            return
+        except QueueFull:
+            if time.monotonic() >= deadline:
+                raise
+            #also lets the device's sender run, an in-memory upload is read without ever yielding
+            await asyncio.sleep(AUDIO_QUEUE_RETRY)
+
+
+async def forward_audio(topic: str, stream_id: int, chunks, first: bool, last: bool):
+    """
+    Queue each chunk as its own audio frame as soon as it arrives.
+
+    If the device stays too far behind, the stream's frames still queued are
+    removed rather than left to play later, and the client gets a 429.
+    """
+    flags = FLAG_START if first else 0
+    queued = 0
+    try:
+        async for chunk in chunks:
+            if not chunk:
+                continue
+            await queue_audio(topic, {"type": "audio", "data": chunk, "stream": stream_id, "flags": flags})
+            flags = 0
+            queued += 1
+        if last:
+            await queue_audio(topic, {"type": "audio", "data": b"", "stream": stream_id, "flags": flags | FLAG_END})
+    except QueueFull:
+        removed = await command_broker.discard_stream(topic, stream_id)
+        if not first or removed < queued:
+            #part of the stream already went out, end it there instead of leaving the device waiting on it
+            try:
+                await command_broker.publish(topic, {"type": "audio", "data": b"", "stream": stream_id, "flags": FLAG_END})
+            except QueueFull:
+                pass
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="Device has too many pending commands")
+
+
+async def run_until_disconnect(websocket: WebSocket, sender, receiver=None, endpoint: str = "other"):
+    """
+    Run sender() alongside a receive loop and stop it as soon as the client goes away.
+
+    Messages from the client, text or bytes, are passed to receiver(data) if one is given.
+    """
+    WS_CONNECTIONS.inc(endpoint)
+    send_task = asyncio.create_task(sender())
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            if receiver is None:
+                continue
+            data = message.get("text")
+            if data is None:
+                data = message.get("bytes")
+            if data is not None:
+                await receiver(data)
+    finally:
+        send_task.cancel()
+        WS_CONNECTIONS.dec(endpoint)
+
+
+async def authenticate_device(websocket: WebSocket, device: str) -> bool:
+    """
+    Wait for the device's {"type": "hello", "key": ...} and check it against user_devices.
+
+    The key is sent as the first message rather than in the URL, which ends
+    up in access logs. Until it matches nothing else is read from the socket
+    and no commands are handed to it; otherwise the socket is closed.
+    """
+    try:
+        message = await asyncio.wait_for(websocket.receive(), DEVICE_AUTH_TIMEOUT)
+    except asyncio.TimeoutError:
+        message = {}
+    try:
+        hello = json.loads(message.get("text") or "")
+    except ValueError:
+        hello = None
+    key = hello.get("key") if isinstance(hello, dict) and hello.get("type") == "hello" else None
+    if isinstance(key, str) and device_key_matches(key, await get_device_key_hash(device)):
+        return True
+    print(f"Device {device} failed to authenticate")
+    if message.get("type") != "websocket.disconnect":
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+    return False
+
+
 @app.websocket("/ws/motor")
-async def motor_ws(websocket: WebSocket):
+async def motor_ws(websocket: WebSocket, device: str = DEFAULT_DEVICE_TOPIC):
+    """A device's motor commands only; like /ws/live it has to send its key first."""
     await websocket.accept()
-    while True:
-        if motor_queue:
-            motor = motor_queue.pop(0)
-            await websocket.send_json({"motor": motor})
-        await asyncio.sleep(1) 
+    if not await authenticate_device(websocket, device):
+        return
+    consumer = Consumer(command_broker, device, kinds=("command",))
+
+    async def sender():
+        while True:
+            message = await consumer.next()
+            await websocket.send_json({"motor": message["motor"]})
+            WS_SENT.inc("motor", "command")
+            await consumer.sent(message)
+
+    try:
+        await run_until_disconnect(websocket, sender, endpoint="motor")
+    finally:
+        await consumer.close()
+    print("Motor client disconnected")
 
 
 @app.websocket("/ws/live")
-async def live_ws(websocket: WebSocket):
+async def live_ws(
+    websocket: WebSocket,
+    device: str = DEFAULT_DEVICE_TOPIC,
+    proto: int = PROTO_JSON,
+    ack: bool = False,
+    resume: Optional[int] = None,
+):
+    """
+    The device's command stream.
+
+    Devices that connect with ack=1 confirm each motor and camera command with
+    {"type": "ack", "id": ...}; whatever they had not confirmed when their last
+    connection dropped is sent again first, except commands up to the id given
+    as resume, which the device says it already ran. Without ack=1 commands
+    count as delivered once sent. Devices on protocol 2 also send their camera
+    up this connection as binary video frames, which go out to /ws/video.
+    Motor and camera commands carry a "trace"; the device returns it with its
+    own timestamps in {"type": "trace", ...} once the move is done.
+    The first message has to be {"type": "hello", "key": ...} with the
+    device's key from user_devices, or the connection is closed.
+    """
     await websocket.accept()
-    try:
+    if not await authenticate_device(websocket, device):
+        return
+    consumer = Consumer(command_broker, device, acked_kinds=ACKED_KINDS if ack else ())
+    if ack:
+        if resume is not None:
+            await command_broker.ack_through(device, resume)
+        await command_broker.redeliver(device)
+
+    #protocol 1 devices only play whole clips, so their streams are collected here first
+    partial_audio = {}
+    #commands and video settings are sent from separate tasks, one message at a time
+    send_lock = asyncio.Lock()
+
+    async def send_command(message: dict):
+        if message["type"] == "audio":
+            if proto >= PROTO_BINARY:
+                #raw bytes behind a small header, no base64 or JSON
+                frame = encode_frame(KIND_AUDIO, message["data"], message["stream"], message["flags"])
+                async with send_lock:
+                    await websocket.send_bytes(frame)
+                WS_SENT.inc("live", "audio")
+                return
+            if message["flags"] & FLAG_START:
+                partial_audio[message["stream"]] = bytearray()
+            clip = partial_audio.setdefault(message["stream"], bytearray())
+            clip += message["data"]
+            if not message["flags"] & FLAG_END:
+                return
+            del partial_audio[message["stream"]]
+            audio_b64 = base64.b64encode(clip).decode("utf-8")
+            message = {"type": "audio", "data": audio_b64}
+
+        message = command_tracer.sent(message)
+        async with send_lock:
+            await websocket.send_json(message)
+        WS_SENT.inc("live", message["type"])
+
+    async def command_sender():
         while True:
-            
-    
-            if motor_queue:
-                motor = motor_queue.pop(0)
-                await websocket.send_json({
-                    "type": "command", 
-                    "motor": motor
-                })
+            #wait for the next command for this device instead of polling
+            message = await consumer.next()
+            await send_command(message)
+            await consumer.sent(message)
+
+    async def video_control_sender():
+        #tell the camera to pause, slow down or speed up as viewers come, go and fall behind
+        controller = video_relay.controller(device)
+        version = None
+        while True:
+            version, settings = await controller.next_settings(version)
+            async with send_lock:
+                await websocket.send_json(settings)
+            WS_SENT.inc("live", "video_ctl")
+
+    async def sender():
+        if proto >= PROTO_BINARY:
+            await asyncio.gather(command_sender(), video_control_sender())
+        else:
+            await command_sender()
+
+    async def receiver(data):
+        if isinstance(data, bytes):
+            #binary frames from the device are camera frames for its viewers
+            try:
+                kind, _, _, payload = decode_frame(data)
+            except FrameError as e:
+                print(f"Bad frame from {device}: {e}")
+                return
+            if kind == KIND_VIDEO:
+                video_relay.publish(device, bytes(payload))
+            return
+        try:
+            reply = json.loads(data)
+        except ValueError:
+            return
+        if not isinstance(reply, dict):
+            return
+        if reply.get("type") == "ack":
+            message_id = reply.get("id")
+            #a malformed ack is ignored rather than taking the device's socket down
+            if isinstance(message_id, int) and not isinstance(message_id, bool):
+                await consumer.ack(message_id)
+        elif reply.get("type") == "event":
+            #e.g. pet_detected from the camera's motion detector
+            print(f"Device {device} event: {reply.get('event')}")
+            video_relay.publish_event(device, {**reply, "device": device})
+        elif reply.get("type") == "trace":
+            #the device finished a traced command
+            command_tracer.complete(device, reply.get("kind", "command"), reply.get("trace"), reply.get("ok", True))
 
-            if cam_queue:
-                direction = cam_queue.pop(0)
-                await websocket.send_json({
-                    "type": "cam",
-                    "direction": direction
-                })
+    try:
+        await run_until_disconnect(websocket, sender, receiver, endpoint="live")
+    finally:
+        await consumer.close()
+    print("Client disconnected")
 
-            if audio_out_queue:
-                audio_binary = audio_out_queue.pop(0)
-                audio_b64 = base64.b64encode(audio_binary).decode("utf-8")
-                await websocket.send_json({
-                    "type": "audio",
-                    "data": audio_b64
-                })
 
-            await asyncio.sleep(0.01)
 
-    except WebSocketDisconnect:
-        print("Client disconnected")
 
+@app.websocket("/ws/video")
+async def video_ws(websocket: WebSocket, device: Optional[str] = None):
+    """
+    Relay one of the logged-in user's cameras as binary JPEG messages, newest frame first.
+
+    Device events such as pet_detected arrive in between as JSON text messages.
+    """
+    session = await validate_session(websocket)
+    if isinstance(session, RedirectResponse):
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    devices = await get_user_devices(session["user_id"])
+    if device is None:
+        device = devices[0] if devices else DEFAULT_DEVICE_TOPIC
+    elif device not in devices:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+
+    viewer = video_relay.join(device)
 
+    async def sender():
+        while True:
+            message = await viewer.next_message()
+            if isinstance(message, dict):
+                await websocket.send_json(message)
+                WS_SENT.inc("video", "event")
+            else:
+                await websocket.send_bytes(message)
+                WS_SENT.inc("video", "frame")
+
+    try:
+        await run_until_disconnect(websocket, sender, endpoint="video")
+    finally:
+        video_relay.leave(device, viewer)
 
 
 @app.get("/feed", response_class=HTMLResponse)
 async def live_page(request : Request):
-    return HTMLResponse(read_html("app/public/feed.html"))
+    return asset_cache.page(request, "feed.html")
 
 @app.get("/dispense", response_class=HTMLResponse)
 async def dispense_page(request: Request):
-    return HTMLResponse(read_html("app/public/dispense.html"))
+    return asset_cache.page(request, "dispense.html")
 
 
 
@@ -245,14 +662,10 @@ async def dispense_page(request: Request):
 async def login_page(request: Request):
     """Show login if not logged in, or redirect to profile page"""
     #check if a sessionId is attached to cookies and validate
-    sessionid = request.cookies.get("session_id")
-    if sessionid:
-        session = await get_session(sessionid) #get session from sessionID
-        if session:
-            user = await get_user_by_id(session['user_id']) #get user from session 
-            if user: #if valid go to profile
-                return RedirectResponse(url=f"/user/{user['name']}")
-    return HTMLResponse(read_html("app/public/login.html"))
+    session = await load_session(request)
+    if session: #if valid go to profile
+        return RedirectResponse(url=f"/user/{session['user']['name']}")
+    return asset_cache.page(request, "login.html")
 
 
 @app.post("/login")
@@ -264,19 +677,15 @@ async def login(request: Request):
     password = form.get("password")
 
     if not email or not password:
-        return HTMLResponse(read_html("app/public/login.html"))
+        return asset_cache.page(request, "login.html")
 
-    hashed_password = hashlib.pbkdf2_hmac('sha256', password.encode(), SYSTEM_SALT, 100000)
-    password = hashed_password.hex()
-    
     #check if email exists and password matches
-    user = await get_user_by_email(email)
-    if not user or user['password'] != password:
+    user = await authenticate(email, password)
+    if not user:
         return HTMLResponse(get_error_email(email), status_code=403)
 
     #creating new session
-    sessionId = str(uuid.uuid4())
-    await create_session(user['id'], sessionId)
+    sessionId = await session_backend.create_session(user['id'])
 
     #response = redirect + cookie
     response = RedirectResponse(url=f"/user/{user['name']}", status_code = 302)
@@ -287,15 +696,10 @@ async def login(request: Request):
 #signup page routes (basic get html for now)
 @app.get("/signup", response_class=HTMLResponse, include_in_schema=False)
 async def get_html(request:Request) -> HTMLResponse:
-    sessionid = request.cookies.get("session_id")
-    if sessionid:
-        session = await get_session(sessionid) #get session from sessionID
-        if session:
-            user = await get_user_by_id(session['user_id']) #get user from session 
-            if user: #if valid go to profile
-                return RedirectResponse(url=f"/user/{user['name']}")
-    with open("app/public/signup.html") as html:
-        return HTMLResponse(content=html.read())
+    session = await load_session(request)
+    if session: #if valid go to profile
+        return RedirectResponse(url=f"/user/{session['user']['name']}")
+    return asset_cache.page(request, "signup.html")
 
 
 
@@ -307,9 +711,6 @@ async def signup(request: Request):
     email = form.get("email")
     password = form.get("password")
 
-    hashed_password = hashlib.pbkdf2_hmac('sha256', password.encode(), SYSTEM_SALT, 100000)
-    password = hashed_password.hex()
-
     location = form.get("location")
 
     #check if the user already exists
@@ -317,22 +718,15 @@ async def signup(request: Request):
     if existing_user:
         raise HTTPException(status_code=400, detail="Email already registered")
 
+    password = await password_hasher.hash(password)
+
     #else - > insert the new user into the database
-    cursor, db = connectdb()
     try:
-        cursor.execute(
-            "INSERT INTO users (name, email, password, location) VALUES (%s, %s, %s, %s)",
-            (name, email, password, location)
-        )
-        #save to database
-        db.commit()
+        await create_user(name, email, password, location)
     except Exception as e:
-        db.rollback()
         raise HTTPException(status_code=500, detail="Database error")
-    finally:
-        db.close()
     #go to login page after to login as a user
-    return HTMLResponse(read_html("app/public/login.html")) 
+    return asset_cache.page(request, "login.html") 
 
 @app.post("/api/signup", status_code=201)
 async def api_signup(payload: SignupRequest):
@@ -343,38 +737,22 @@ async def api_signup(payload: SignupRequest):
             detail="Email is already registered"
         )
     
-    hashed = hashlib.pbkdf2_hmac("sha256", payload.password.encode(), SYSTEM_SALT, 100000)
-    password = hashed.hex()
+    password = await password_hasher.hash(payload.password)
 
-    cursor, db = connectdb()
     try:
-        cursor.execute(
-            """
-            INSERT INTO users (name, email, password, location)
-            VALUES (%s, %s, %s, %s)
-            """, (payload.name, payload.email, password, payload.location),
-        )
-        db.commit()
-        new_id = cursor.lastrowid
+        new_id = await create_user(payload.name, payload.email, password, payload.location)
     except Exception as e:
-        db.rollback()
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail = "Database error")
-    finally:
-        db.close()
 
     return {"id": new_id, "name": payload.name, "email": payload.email}
 
 @app.post("/api/login", status_code=status.HTTP_200_OK)
 async def api_login(payload: LoginRequest, response: Response):
-    hashed_password = hashlib.pbkdf2_hmac("sha256", payload.password.encode(), SYSTEM_SALT, 100000)
-    password = hashed_password.hex()
-
-    user = await get_user_by_email(payload.email)
-    if not user or user["password"] != password:
+    user = await authenticate(payload.email, payload.password)
+    if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid email or password")
     
-    session_id = str(uuid.uuid4())
-    await create_session(user["id"], session_id)
+    session_id = await session_backend.create_session(user["id"])
 
     response.set_cookie("session_id", session_id)
 
@@ -382,27 +760,24 @@ async def api_login(payload: LoginRequest, response: Response):
 
 #user hub page route
 @app.get("/user/{name}", response_class=HTMLResponse)
-async def user_page(name: str, request: Request):
-    session_result = await validate_session(request)
+async def user_page(name: str, request: Request, session_result = Depends(validate_session)):
     if isinstance(session_result, RedirectResponse):
         return session_result
-    user = await get_user_by_id(session_result['user_id'])
-    if not user or user['name'] != name:
+    user = session_result['user']
+    if user['name'] != name:
         return HTMLResponse(get_error_html(name), status_code = 403)
 
     #If all valid, show profile page
-    return HTMLResponse(read_html("app/public/profile.html"))
+    return asset_cache.page(request, "profile.html")
 
 
 
 #profile page routes (basic get html for now)
 @app.get("/profile", response_class=HTMLResponse, include_in_schema=False)
-async def get_html(request:Request) -> HTMLResponse:
-    session_result = await validate_session(request)
+async def get_html(request:Request, session_result = Depends(validate_session)) -> HTMLResponse:
     if isinstance(session_result, RedirectResponse):
         return session_result
-    with open("app/public/profile_devices.html") as html:
-        return HTMLResponse(content=html.read())
+    return asset_cache.page(request, "profile_devices.html")
 
 #logout route
 
@@ -415,23 +790,158 @@ async def logout(request: Request):
     response = RedirectResponse(url="/login")
     #Delete sessionId cookie, and delete sessionId from database
     if sessionId:
-        await delete_session(sessionId)
-    response.delete_cookie("sessionId")
+        await session_backend.delete_session(sessionId)
+    response.delete_cookie("session_id")
     #Return response
     return response
 
 
+def sensor_row(reading: SensorValues) -> tuple:
+    try:
+        #fromisoformat only takes a "Z" suffix from Python 3.11
+        timestamp = datetime.fromisoformat(reading.timestamp.replace("Z", "+00:00"))
+    except ValueError:
+        raise HTTPException(status_code=422, detail=f"Invalid timestamp {reading.timestamp}")
+    #stored naive, so the raw row and its rollups agree on the time
+    return (reading.topic, reading.temp, naive_utc(timestamp))
+
+
+@app.post("/sensor_data", status_code=status.HTTP_202_ACCEPTED)
+async def receive_sensor_data(reading: SensorValues):
+    """Buffer one reading; it is written to the database with the next batch."""
+    sensor_ingestor.add([sensor_row(reading)])
+    sensor_hub.publish(reading.topic, reading.dict())
+    return {"accepted": 1}
+
+
+@app.post("/sensor_data/batch", status_code=status.HTTP_202_ACCEPTED)
+async def receive_sensor_batch(readings: List[SensorValues]):
+    """Buffer many readings at once."""
+    sensor_ingestor.add([sensor_row(reading) for reading in readings])
+    for reading in readings:
+        sensor_hub.publish(reading.topic, reading.dict())
+    return {"accepted": len(readings)}
+
+
+@app.websocket("/ws/sensors")
+async def sensors_ws(websocket: WebSocket, topic: Optional[str] = None):
+    """
+    Push live readings for the logged-in user's devices, batched as JSON arrays.
+
+    ?topic= narrows it to one device or a subtopic of one, e.g. pet1/temperature.
+    """
+    session = await validate_session(websocket)
+    if isinstance(session, RedirectResponse):
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    topics = await get_user_devices(session["user_id"])
+    if topic is not None:
+        topics = [topic] if any(within(topic, device) for device in topics) else []
+    await websocket.accept()
+
+    subscription = sensor_hub.subscribe(topics)
+
+    async def sender():
+        while True:
+            await websocket.send_text(await subscription.next_batch())
+            WS_SENT.inc("sensors", "batch")
+
+    try:
+        await run_until_disconnect(websocket, sender, endpoint="sensors")
+    finally:
+        sensor_hub.unsubscribe(subscription)
+
+
+@app.get("/api/sensors/{topic:path}/history")
+async def sensor_history(
+    topic: str,
+    request: Request,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    points: int = Query(500, ge=1, le=10000),
+):
+    """
+    Downsampled history for one of the logged-in user's device topics (or a subtopic) from the rollup tables.
+
+    Uses the finest of the minute/hour/day rollups that keeps the number of
+    buckets in the range within the points budget, so the cost of a query
+    depends on the points asked for rather than how many raw readings exist.
+    Times with a timezone are converted to UTC, times without one are taken
+    as they are stored.
+    """
+    session = await load_session(request)
+    if not session:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not logged in")
+    devices = await get_user_devices(session["user_id"])
+    if not any(within(topic, device) for device in devices):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Unknown topic")
+
+    end = naive_utc(end) if end else datetime.now()
+    start = naive_utc(start) if start else end - timedelta(days=1)
+    if start >= end:
+        raise HTTPException(status_code=422, detail="start must be before end")
+
+    resolution = pick_resolution((end - start).total_seconds(), points)
+    rows = await get_sensor_rollups(topic, resolution, bucket_floor(start, resolution), end)
+    return {
+        "topic": topic,
+        "resolution": resolution,
+        "points": [
+            {
+                "time": row["bucket_start"].isoformat(),
+                "min": row["min_temp"],
+                "max": row["max_temp"],
+                "avg": row["avg_temp"],
+                "count": row["count"],
+            }
+            for row in rows
+        ],
+    }
+
+
 @app.post("/movecam")
 async def move_cam(request: Request):
     data = await request.json()
     direction = data.get("direction")
-    cam_queue.append(direction)
+    topic = await resolve_device(request, data.get("device"))
+    trace_id = await queue_command(topic, {"type": "cam", "direction": direction}, request.state.received_at)
     print(f"Move camera: {direction}")
-    return {"status": "ok", "direction": direction}
+    return {"status": "ok", "direction": direction, "trace_id": trace_id}
+
+
+@app.get("/api/traces")
+async def command_traces(
+    request: Request,
+    device: Optional[str] = None,
+    trace_id: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=TRACE_BUFFER),
+):
+    """
+    The most recent finished motor and camera command traces, newest first.
+
+    Each has the seconds spent in the request handler, the device's queue on the
+    server, the network, the device's own queue and the move itself. Only
+    the logged-in user's devices (or the default one, if they have none, as
+    for commands) connected to the worker answering the request are included.
+    """
+    session = await load_session(request)
+    if not session:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not logged in")
+    devices = await get_user_devices(session["user_id"]) or [DEFAULT_DEVICE_TOPIC]
+    if device is not None:
+        if device not in devices:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Unknown device")
+        devices = [device]
+    return {"traces": command_tracer.recent(set(devices), trace_id, limit)}
+
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics_page():
+    """Counters, gauges and histograms for this worker in the Prometheus text format."""
+    return PlainTextResponse(await metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4")
 
 
 
 if __name__ == "__main__":
    uvicorn.run(app="app.main:app", host="0.0.0.0", port=6543, reload=True)
-   
\ No newline at end of file
+   
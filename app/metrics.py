@@ -0,0 +1,180 @@
+import asyncio
+import bisect
+import math
+import threading
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List, Tuple
+
+
+#seconds; covers a cached page (sub-ms) up to a slow PBKDF2 or database call
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Sharded:
+    """
+    Values kept per thread and only added up when scraped.
+
+    Each thread updates its own dict, so the event loop and the database and
+    hashing executor threads never contend on a lock to record a sample; the
+    lock is only taken the first time a thread records anything.
+    """
+
+    def __init__(self, factory: Callable):
+        self._factory = factory
+        self._local = threading.local()
+        self._shards: List[dict] = []
+        self._lock = threading.Lock()
+
+    def shard(self) -> dict:
+        values = getattr(self._local, "values", None)
+        if values is None:
+            values = self._local.values = defaultdict(self._factory)
+            with self._lock:
+                self._shards.append(values)
+        return values
+
+    def shards(self) -> List[dict]:
+        with self._lock:
+            return list(self._shards)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, description: str, labelnames: Iterable[str] = (), registry: "Registry" = None):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        (registry or REGISTRY).register(self)
+
+    async def samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values = _Sharded(float)
+
+    def inc(self, *labels, amount: float = 1):
+        self._values.shard()[labels] += amount
+
+    def totals(self) -> Dict[Tuple, float]:
+        totals = defaultdict(float)
+        for shard in self._values.shards():
+            for labels, value in list(shard.items()):
+                totals[labels] += value
+        return totals
+
+    async def samples(self) -> List[str]:
+        return [f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}" for labels, value in sorted(self.totals().items())]
+
+
+class Gauge(Counter):
+    """A value that goes up and down, e.g. open connections; dec() is inc() of a negative amount."""
+
+    kind = "gauge"
+
+    def dec(self, *labels, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, labelnames: Iterable[str] = (), buckets: Iterable[float] = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(name, description, labelnames, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+        #per label set: one count per bucket (the last is +Inf), then the sum
+        self._values = _Sharded(lambda: [0] * (len(self.buckets) + 1) + [0.0])
+
+    def observe(self, value: float, *labels):
+        counts = self._values.shard()[labels]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    async def samples(self) -> List[str]:
+        merged: Dict[Tuple, list] = {}
+        for shard in self._values.shards():
+            for labels, counts in list(shard.items()):
+                total = merged.setdefault(labels, [0] * len(counts))
+                for index, value in enumerate(counts):
+                    total[index] += value
+        lines = []
+        for labels, counts in sorted(merged.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = 'le="' + _number(bound) + '"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(counts[-1])}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class Collected(Metric):
+    """
+    A value read from elsewhere at scrape time, such as a queue depth.
+
+    callback returns a number, or a {label values: number} dict when the
+    metric has labels; it may be a coroutine function.
+    """
+
+    def __init__(self, name: str, description: str, callback: Callable, kind: str = "gauge", labelnames: Iterable[str] = (), **kwargs):
+        super().__init__(name, description, labelnames, **kwargs)
+        self.kind = kind
+        self.callback = callback
+
+    async def samples(self) -> List[str]:
+        result = self.callback()
+        if asyncio.iscoroutine(result):
+            result = await result
+        if not isinstance(result, dict):
+            result = {(): result}
+        lines = []
+        for labels, value in sorted(result.items()):
+            if not isinstance(labels, tuple):
+                labels = (labels,)
+            lines.append(f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} registered twice")
+        self._metrics[metric.name] = metric
+
+    async def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(await metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
@@ -0,0 +1,164 @@
+import logging
+
+from mysql.connector import Error
+
+
+logger = logging.getLogger(__name__)
+
+#name of the MySQL advisory lock held while migrating, so workers starting together take turns
+MIGRATION_LOCK = "petpal_schema_migrations"
+MIGRATION_LOCK_TIMEOUT = 60
+
+#errors meaning the object a statement creates is already there, e.g. from before migrations existed
+ALREADY_APPLIED_ERRORS = (
+    1050,  # ER_TABLE_EXISTS_ERROR
+    1060,  # ER_DUP_FIELDNAME
+    1061,  # ER_DUP_KEYNAME
+)
+
+# (version, description, statements); append new migrations at the end, never edit applied ones
+MIGRATIONS = [
+    (1, "initial schema", [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            name VARCHAR(255) NOT NULL,
+            email VARCHAR(255) NOT NULL UNIQUE,
+            password VARCHAR(255) NOT NULL,
+            location VARCHAR(255) NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS sessions (
+            id VARCHAR(36) PRIMARY KEY,
+            user_id INT NOT NULL,
+            start_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS user_devices (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            user_id INT NOT NULL,
+            device_topic VARCHAR(255) NOT NULL UNIQUE,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS sensor_data (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            topic VARCHAR(255) NOT NULL,
+            temp DOUBLE NOT NULL,
+            timestamp DATETIME NOT NULL,
+            INDEX idx_sensor_data_topic_time (topic, timestamp)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS sensor_rollups (
+            topic VARCHAR(255) NOT NULL,
+            resolution INT NOT NULL,
+            bucket_start DATETIME NOT NULL,
+            min_temp DOUBLE NOT NULL,
+            max_temp DOUBLE NOT NULL,
+            sum_temp DOUBLE NOT NULL,
+            count INT NOT NULL,
+            PRIMARY KEY (topic, resolution, bucket_start)
+        )
+        """,
+    ]),
+    (2, "index sessions.last_active for expiry and users.name for lookups", [
+        "CREATE INDEX idx_sessions_last_active ON sessions (last_active)",
+        "CREATE INDEX idx_users_name ON users (name)",
+    ]),
+    (3, "revocation list for signed session tokens", [
+        """
+        CREATE TABLE IF NOT EXISTS session_revocations (
+            session_id VARCHAR(64) PRIMARY KEY,
+            expires_at DATETIME NOT NULL,
+            INDEX idx_session_revocations_expires (expires_at)
+        )
+        """,
+    ]),
+    (4, "shared device command queues", [
+        """
+        CREATE TABLE IF NOT EXISTS device_commands (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            topic VARCHAR(255) NOT NULL,
+            kind VARCHAR(16) NOT NULL,
+            payload TEXT NOT NULL,
+            data LONGBLOB NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            INDEX idx_device_commands_topic (topic, id)
+        )
+        """,
+    ]),
+    #rows queued before TTLs existed default to already expired
+    (5, "expiry and delivery tracking for device commands", [
+        "ALTER TABLE device_commands ADD COLUMN expires_at DATETIME(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3)",
+        "ALTER TABLE device_commands ADD COLUMN delivered_at DATETIME(3) NULL",
+    ]),
+    #devices registered before keys existed have none and are refused until one is set
+    (6, "per-device keys for the device websockets", [
+        "ALTER TABLE user_devices ADD COLUMN device_key_hash CHAR(64) NULL",
+    ]),
+    #kept apart from delivered_at, which is cleared again when a command goes back in the queue
+    (7, "mark device commands that were handed out before", [
+        "ALTER TABLE device_commands ADD COLUMN redelivered BOOLEAN NOT NULL DEFAULT FALSE",
+    ]),
+    (8, "per-device rows that publishers lock to take turns", [
+        """
+        CREATE TABLE IF NOT EXISTS device_queues (
+            topic VARCHAR(255) PRIMARY KEY
+        )
+        """,
+    ]),
+]
+
+
+def apply_migrations(cursor, connection) -> int:
+    """
+    Bring the schema up to the latest version and return it.
+
+    Applied versions are recorded in schema_migrations, so running this on
+    every startup only executes what is new.
+    """
+    cursor.execute("SELECT GET_LOCK(%s, %s) AS locked", (MIGRATION_LOCK, MIGRATION_LOCK_TIMEOUT))
+    if not cursor.fetchone()["locked"]:
+        raise RuntimeError("Timed out waiting for another worker to finish migrating")
+    try:
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INT PRIMARY KEY,
+                description VARCHAR(255) NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            """
+        )
+        cursor.execute("SELECT COALESCE(MAX(version), 0) AS version FROM schema_migrations")
+        current = cursor.fetchone()["version"]
+
+        for version, description, statements in MIGRATIONS:
+            if version <= current:
+                continue
+            logger.info(f"Applying migration {version}: {description}")
+            for statement in statements:
+                try:
+                    cursor.execute(statement)
+                except Error as e:
+                    if e.errno not in ALREADY_APPLIED_ERRORS:
+                        logger.error(f"Migration {version} failed: {e}")
+                        raise
+                    logger.info(f"Migration {version}: already present, skipping ({e.msg})")
+            cursor.execute(
+                "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)", (version, description)
+            )
+            connection.commit()
+            current = version
+
+        logger.info(f"Database schema at version {current}")
+        return current
+    finally:
+        cursor.execute("SELECT RELEASE_LOCK(%s)", (MIGRATION_LOCK,))
+        cursor.fetchall()
@@ -0,0 +1,130 @@
+import asyncio
+import hashlib
+import hmac
+import logging
+import os
+import secrets
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+from app import metrics
+
+
+logger = logging.getLogger(__name__)
+
+#salt used by every password hashed before per-user salts existed
+SYSTEM_SALT = b"my-fixed-salt-12345"
+LEGACY_ITERATIONS = 100000
+
+HASH_SCHEME = "pbkdf2_sha256"
+PASSWORD_ITERATIONS = int(os.getenv("PASSWORD_ITERATIONS", 100000))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", 2))          #threads doing PBKDF2
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", 32)) #running + queued hashes before 429
+SALT_BYTES = 16
+
+PASSWORD_HASH_SECONDS = metrics.Histogram("petpal_password_hash_seconds", "PBKDF2 time per hash on the hashing threads")
+
+
+class HasherBusy(Exception):
+    """Raised when too many hashes are already running or queued."""
+
+
+def _pbkdf2(password: str, salt: bytes, iterations: int) -> bytes:
+    started = time.perf_counter()
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
+    PASSWORD_HASH_SECONDS.observe(time.perf_counter() - started)
+    return digest
+
+
+def _encode(salt: bytes, iterations: int, digest: bytes) -> str:
+    return f"{HASH_SCHEME}${iterations}${salt.hex()}${digest.hex()}"
+
+
+def _parse(stored: str) -> Tuple[bytes, int, bytes, bool]:
+    """Split a stored hash into (salt, iterations, digest, is_legacy)."""
+    if "$" not in stored:
+        #legacy rows are a bare hex digest made with SYSTEM_SALT
+        return SYSTEM_SALT, LEGACY_ITERATIONS, bytes.fromhex(stored), True
+    scheme, iterations, salt, digest = stored.split("$")
+    if scheme != HASH_SCHEME:
+        raise ValueError(f"Unknown password hash scheme {scheme}")
+    return bytes.fromhex(salt), int(iterations), bytes.fromhex(digest), False
+
+
+def hash_device_key(key: str) -> str:
+    """SHA-256 hex of a device key, what user_devices.device_key_hash holds (same as MySQL's SHA2(key, 256))."""
+    #keys are 256 random bits, not something a person picked, so no salt or PBKDF2 is needed
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def new_device_key() -> Tuple[str, str]:
+    """A fresh device key and its hash; the key is only ever shown to whoever sets up the device."""
+    key = secrets.token_urlsafe(32)
+    return key, hash_device_key(key)
+
+
+def device_key_matches(key: str, stored_hash: Optional[str]) -> bool:
+    if not stored_hash:
+        return False
+    return hmac.compare_digest(hash_device_key(key), stored_hash)
+
+
+class PasswordHasher:
+    """
+    Runs PBKDF2 on a small dedicated thread pool so it never blocks the event loop.
+
+    hashlib releases the GIL while deriving the key, so the threads run in parallel
+    with the loop. At most max_pending hashes may be running or waiting; beyond that
+    callers get HasherBusy instead of an ever-growing queue.
+    """
+
+    def __init__(self, iterations: int, workers: int, max_pending: int):
+        self.iterations = iterations
+        self.workers = workers
+        self.max_pending = max_pending
+        self._pending = 0
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._dummy = _encode(b"\0" * SALT_BYTES, iterations, b"\0" * 32)
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    async def _derive(self, password: str, salt: bytes, iterations: int) -> bytes:
+        if self._pending >= self.max_pending:
+            raise HasherBusy()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="pbkdf2")
+        self._pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, _pbkdf2, password, salt, iterations)
+        finally:
+            self._pending -= 1
+
+    async def hash(self, password: str) -> str:
+        """Hash a password with a fresh per-user salt."""
+        salt = os.urandom(SALT_BYTES)
+        digest = await self._derive(password, salt, self.iterations)
+        return _encode(salt, self.iterations, digest)
+
+    async def verify(self, password: str, stored: Optional[str]) -> Tuple[bool, bool]:
+        """
+        Check a password against a stored hash.
+
+        Returns (matches, needs_rehash). Pass stored=None for an unknown user so the
+        response takes as long as a real check.
+        """
+        salt, iterations, expected, legacy = _parse(stored or self._dummy)
+        digest = await self._derive(password, salt, iterations)
+        matches = stored is not None and hmac.compare_digest(digest, expected)
+        return matches, matches and (legacy or iterations != self.iterations)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+password_hasher = PasswordHasher(PASSWORD_ITERATIONS, PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_PENDING)
@@ -0,0 +1,45 @@
+import struct
+from typing import Tuple
+
+
+#Binary frames on /ws/live: a fixed header followed by the raw payload.
+#  version (u8) | kind (u8) | flags (u8) | reserved (u8) | stream id (u32) | payload length (u32)
+#JSON text messages are still used for control commands and for clients on protocol 1.
+FRAME_VERSION = 1
+FRAME_HEADER = struct.Struct("!BBBxII")
+
+KIND_AUDIO = 1  #server to device, a chunk of an audio stream
+KIND_VIDEO = 2  #device to server, one JPEG camera frame
+
+FLAG_START = 0x01  #first frame of a stream
+FLAG_END = 0x02    #last frame of a stream
+
+#protocol version a device asks for with ?proto=; 2 and up understands binary frames
+PROTO_JSON = 1
+PROTO_BINARY = 2
+
+
+class FrameError(ValueError):
+    """Raised for frames that are truncated or from an unknown version."""
+
+
+def encode_frame(kind: int, payload: bytes, stream_id: int = 0, flags: int = FLAG_START | FLAG_END) -> bytearray:
+    """Build a frame with a single copy of the payload into the output buffer."""
+    frame = bytearray(FRAME_HEADER.size + len(payload))
+    FRAME_HEADER.pack_into(frame, 0, FRAME_VERSION, kind, flags, stream_id, len(payload))
+    frame[FRAME_HEADER.size:] = payload
+    return frame
+
+
+def decode_frame(data: bytes) -> Tuple[int, int, int, memoryview]:
+    """Return (kind, flags, stream_id, payload) where payload is a view into data, not a copy."""
+    view = memoryview(data)
+    if len(view) < FRAME_HEADER.size:
+        raise FrameError("Frame shorter than header")
+    version, kind, flags, stream_id, length = FRAME_HEADER.unpack_from(view)
+    if version != FRAME_VERSION:
+        raise FrameError(f"Unsupported frame version {version}")
+    end = FRAME_HEADER.size + length
+    if len(view) < end:
+        raise FrameError("Frame payload truncated")
+    return kind, flags, stream_id, view[FRAME_HEADER.size:end]
@@ -0,0 +1,87 @@
+import asyncio
+import json
+import os
+from collections import defaultdict, deque
+from typing import Dict, Iterable, Set
+
+
+SENSOR_SUBSCRIBER_BUFFER = int(os.getenv("SENSOR_SUBSCRIBER_BUFFER", 100))  #readings held per browser before dropping the oldest
+
+
+def within(topic: str, parent: str) -> bool:
+    """True if topic is parent or one of its subtopics, e.g. "pet1/temperature" is within "pet1"."""
+    return topic == parent or topic.startswith(parent + "/")
+
+
+class Subscription:
+    """One browser's view of the hub: a bounded buffer that drops its oldest reading when full."""
+
+    def __init__(self, topics: Iterable[str], maxlen: int):
+        self.topics = set(topics)
+        self.dropped = 0
+        self._pending = deque(maxlen=maxlen)
+        self._ready = asyncio.Event()
+
+    def push(self, encoded: str):
+        if len(self._pending) == self._pending.maxlen:
+            self.dropped += 1
+        self._pending.append(encoded)
+        self._ready.set()
+
+    async def next_batch(self) -> str:
+        """Wait for readings and return everything pending as one JSON array."""
+        while not self._pending:
+            self._ready.clear()
+            await self._ready.wait()
+        batch = "[" + ",".join(self._pending) + "]"
+        self._pending.clear()
+        return batch
+
+
+class SensorHub:
+    """
+    In-process fan-out of live sensor readings.
+
+    Each reading is JSON-encoded once and handed to every subscription for
+    its topic or any parent topic. Publishing never waits on a subscriber,
+    so a slow browser only loses its own oldest readings.
+    """
+
+    def __init__(self, buffer_size: int):
+        self.buffer_size = buffer_size
+        self._subscribers: Dict[str, Set[Subscription]] = defaultdict(set)
+
+    def subscribe(self, topics: Iterable[str]) -> Subscription:
+        subscription = Subscription(topics, self.buffer_size)
+        for topic in subscription.topics:
+            self._subscribers[topic].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        for topic in subscription.topics:
+            subscribers = self._subscribers.get(topic)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[topic]
+
+    def publish(self, topic: str, reading: dict):
+        if not self._subscribers:
+            return
+        encoded = None
+        #a subscription to "pet1" also receives "pet1/temperature"
+        parts = topic.split("/")
+        for depth in range(1, len(parts) + 1):
+            subscribers = self._subscribers.get("/".join(parts[:depth]))
+            if not subscribers:
+                continue
+            if encoded is None:
+                encoded = json.dumps(reading)
+            for subscription in subscribers:
+                subscription.push(encoded)
+
+    def subscriber_count(self) -> int:
+        return len({subscription for subscribers in self._subscribers.values() for subscription in subscribers})
+
+
+sensor_hub = SensorHub(SENSOR_SUBSCRIBER_BUFFER)
@@ -0,0 +1,72 @@
+from datetime import datetime, timedelta, timezone
+from typing import List, Tuple
+
+import numpy as np
+
+
+#bucket sizes kept in sensor_rollups, finest first (1 minute, 1 hour, 1 day)
+RESOLUTIONS = (60, 3600, 86400)
+
+#bucket starts fit in the low bits of the grouping key, the topic index goes above them
+_BUCKET_BITS = 34
+_BUCKET_MASK = (1 << _BUCKET_BITS) - 1
+#naive timestamps are bucketed as if they were UTC, the same way datetime64 treats them
+_EPOCH = datetime(1970, 1, 1)
+
+
+def aggregate(rows: List[Tuple[str, float, datetime]]) -> List[tuple]:
+    """
+    Reduce a batch of (topic, temp, timestamp) readings to rollup rows.
+
+    Returns (topic, resolution, bucket_start, min, max, sum, count) for every
+    topic/bucket the batch touches at every resolution, grouped with NumPy
+    instead of a Python loop over readings.
+    """
+    if not rows:
+        return []
+    topics, temps, stamps = zip(*rows)
+    temps = np.asarray(temps, dtype=np.float64)
+    seconds = np.asarray(stamps, dtype="datetime64[s]").astype(np.int64)
+    topic_names, topic_index = np.unique(np.asarray(topics), return_inverse=True)
+    topic_key = topic_index.astype(np.int64) << _BUCKET_BITS
+
+    rollups = []
+    for resolution in RESOLUTIONS:
+        keys = topic_key | (seconds // resolution * resolution)
+        groups, group_index = np.unique(keys, return_inverse=True)
+
+        counts = np.bincount(group_index)
+        sums = np.bincount(group_index, weights=temps)
+        mins = np.full(len(groups), np.inf)
+        maxs = np.full(len(groups), -np.inf)
+        np.minimum.at(mins, group_index, temps)
+        np.maximum.at(maxs, group_index, temps)
+
+        names = topic_names[groups >> _BUCKET_BITS]
+        starts = (groups & _BUCKET_MASK).astype("datetime64[s]").astype(datetime)
+        rollups.extend(zip(
+            names.tolist(), [resolution] * len(groups), starts.tolist(),
+            mins.tolist(), maxs.tolist(), sums.tolist(), counts.tolist(),
+        ))
+    return rollups
+
+
+def naive_utc(moment: datetime) -> datetime:
+    """moment as a naive timestamp; ones with a timezone are converted to UTC first."""
+    if moment.tzinfo is None:
+        return moment
+    return moment.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def pick_resolution(span_seconds: float, max_points: int) -> int:
+    """Finest resolution whose bucket count for the span fits in max_points, else the coarsest."""
+    for resolution in RESOLUTIONS:
+        if span_seconds / resolution <= max_points:
+            return resolution
+    return RESOLUTIONS[-1]
+
+
+def bucket_floor(moment: datetime, resolution: int) -> datetime:
+    """Start of the bucket containing moment."""
+    seconds = int((naive_utc(moment) - _EPOCH).total_seconds())
+    return _EPOCH + timedelta(seconds=seconds // resolution * resolution)
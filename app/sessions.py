@@ -0,0 +1,408 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from app import database
+
+
+logger = logging.getLogger(__name__)
+
+#change number value for different time-out time in minutes
+SESSION_TIMEOUT = timedelta(minutes=int(os.getenv("SESSION_TIMEOUT_MINUTES", 5)))
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "mysql")                         #"mysql" or "signed"
+
+SESSION_CACHE_TTL = float(os.getenv("SESSION_CACHE_TTL", 30))                   #seconds a cached session row is trusted
+SESSION_CACHE_MAX_ENTRIES = int(os.getenv("SESSION_CACHE_MAX_ENTRIES", 10000))  #LRU cap on cached sessions
+SESSION_FLUSH_INTERVAL = float(os.getenv("SESSION_FLUSH_INTERVAL", 15))         #seconds between last_active flushes
+SESSION_REAPER_INTERVAL = float(os.getenv("SESSION_REAPER_INTERVAL", 600))      #seconds between expired-session sweeps
+SESSION_REAPER_BATCH_SIZE = int(os.getenv("SESSION_REAPER_BATCH_SIZE", 1000))   #rows per DELETE
+SESSION_REAPER_PAUSE = float(os.getenv("SESSION_REAPER_PAUSE", 0.05))           #seconds between DELETE batches
+SESSION_REAPER_LOCK = "petpal_session_reaper"
+SESSION_SECRET = os.getenv("SESSION_SECRET")                                    #HMAC key for signed session tokens
+SESSION_RENEW_INTERVAL = float(os.getenv("SESSION_RENEW_INTERVAL", 60))         #seconds before a signed token is reissued
+SESSION_REVOCATION_SYNC = float(os.getenv("SESSION_REVOCATION_SYNC", 5))        #seconds between revocation list refreshes
+
+
+class SessionCache:
+    """
+    TTL + LRU cache of session rows keyed by session id.
+
+    Touches update the cached last_active right away and are queued so that
+    flush() can write them back to the database in one batch.
+    """
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  #session_id -> (expires_at, session)
+        self._pending = {}             #session_id -> last_active waiting to be written
+        self._flush_needed = None      #created by run_flusher inside the running loop
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, session_id: str) -> Optional[dict]:
+        entry = self._entries.get(session_id)
+        if entry is None:
+            return None
+        expires_at, session = entry
+        if time.monotonic() >= expires_at:
+            del self._entries[session_id]
+            return None
+        self._entries.move_to_end(session_id)
+        return session
+
+    def put(self, session_id: str, session: dict):
+        #a touch that has not been flushed yet is newer than what the database returned
+        pending = self._pending.get(session_id)
+        if pending is not None and pending > session["last_active"]:
+            session["last_active"] = pending
+        self._entries[session_id] = (time.monotonic() + self.ttl, session)
+        self._entries.move_to_end(session_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def touch(self, session_id: str, when: datetime):
+        entry = self._entries.get(session_id)
+        if entry is not None:
+            entry[1]["last_active"] = when
+        self._pending[session_id] = when
+        if len(self._pending) >= self.max_entries and self._flush_needed is not None:
+            self._flush_needed.set()
+
+    def invalidate(self, session_id: str):
+        """Forget a session and drop any touch still waiting to be written."""
+        self._entries.pop(session_id, None)
+        self._pending.pop(session_id, None)
+
+    def evict(self, session_id: str):
+        """Forget the cached row but keep its pending touch."""
+        self._entries.pop(session_id, None)
+
+    async def flush(self) -> int:
+        """Write all pending last_active touches to the database."""
+        if not self._pending:
+            return 0
+        batch, self._pending = self._pending, {}
+        try:
+            await database.touch_sessions(list(batch.items()))
+        except Exception:
+            #keep touches that were not superseded while we were writing
+            for session_id, when in batch.items():
+                self._pending.setdefault(session_id, when)
+            raise
+        return len(batch)
+
+    async def run_flusher(self, interval: float):
+        """Flush touches every interval seconds, or sooner if too many pile up."""
+        self._flush_needed = asyncio.Event()
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_needed.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_needed.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Flushing session activity failed: {e}")
+
+
+class UserCache:
+    """
+    TTL + LRU cache of user profiles (no password hash) keyed by user id.
+
+    Lets backends whose sessions don't come joined with their user, like
+    signed tokens, attach it without a database round trip per request.
+    """
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  #user_id -> (expires_at, user)
+
+    async def get(self, user_id: int) -> Optional[dict]:
+        entry = self._entries.get(user_id)
+        if entry is not None and time.monotonic() < entry[0]:
+            self._entries.move_to_end(user_id)
+            return entry[1]
+        user = await database.get_user_profile(user_id)
+        if user is None:
+            self._entries.pop(user_id, None)
+            return None
+        self._entries[user_id] = (time.monotonic() + self.ttl, user)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return user
+
+
+user_cache = UserCache(SESSION_CACHE_TTL, SESSION_CACHE_MAX_ENTRIES)
+
+
+class SessionReaper:
+    """
+    Periodically deletes expired sessions in small batches off the event loop.
+
+    Every worker runs one, but the database advisory lock means only one of
+    them sweeps at a time; the others count a skipped run.
+    """
+
+    def __init__(self, interval: float, batch_size: int, pause: float):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self.runs = 0
+        self.skipped = 0
+        self.rows_reaped = 0
+        self.seconds_spent = 0.0
+
+    async def reap(self, timeout: timedelta) -> Optional[int]:
+        started = time.monotonic()
+        deleted = await database.delete_expired_sessions(
+            datetime.now() - timeout, self.batch_size, self.pause, SESSION_REAPER_LOCK
+        )
+        elapsed = time.monotonic() - started
+        if deleted is None:
+            self.skipped += 1
+            return None
+        self.runs += 1
+        self.rows_reaped += deleted
+        self.seconds_spent += elapsed
+        logger.info(f"Reaped {deleted} expired sessions in {elapsed:.2f}s")
+        return deleted
+
+    async def run(self, timeout: timedelta):
+        while True:
+            try:
+                await self.reap(timeout)
+            except Exception as e:
+                logger.error(f"Reaping expired sessions failed: {e}")
+            await asyncio.sleep(self.interval)
+
+
+class SessionBackend:
+    """
+    Where sessions live. validate_session in app/main.py only talks to this interface.
+
+    Session dicts always carry id, user_id, start_time and last_active.
+    """
+
+    async def start(self):
+        """Start any background work; called from the app lifespan."""
+
+    async def stop(self):
+        """Stop background work and write out anything pending."""
+
+    async def create_session(self, user_id: int) -> str:
+        """Start a session and return the value for the session_id cookie."""
+        raise NotImplementedError
+
+    async def get_session(self, token: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    async def get_session_user(self, token: str, reload: bool = False) -> Optional[dict]:
+        """get_session (or reload_session) with the owning user attached under "user"."""
+        session = await (self.reload_session(token) if reload else self.get_session(token))
+        if session and "user" not in session:
+            user = await user_cache.get(session["user_id"])
+            if not user:
+                return None
+            session["user"] = dict(user)
+        return session
+
+    async def reload_session(self, token: str) -> Optional[dict]:
+        """Like get_session but skipping any local copy."""
+        return await self.get_session(token)
+
+    def touch_session(self, token: str, session: dict) -> Optional[str]:
+        """Mark the session active now; returns a new cookie value if the token changed."""
+        raise NotImplementedError
+
+    async def delete_session(self, token: str):
+        raise NotImplementedError
+
+
+class MySQLSessionBackend(SessionBackend):
+    """
+    Sessions rows in MySQL, read through the in-process cache with batched last_active writes.
+
+    Logging out also puts the session id on the shared revocation list for as
+    long as another worker could still have it cached; every worker drops
+    revoked ids from its cache every SESSION_REVOCATION_SYNC seconds.
+    """
+
+    def __init__(self, timeout: timedelta):
+        self.timeout = timeout
+        self.cache = SessionCache(SESSION_CACHE_TTL, SESSION_CACHE_MAX_ENTRIES)
+        self.reaper = SessionReaper(SESSION_REAPER_INTERVAL, SESSION_REAPER_BATCH_SIZE, SESSION_REAPER_PAUSE)
+        self._tasks = []
+
+    async def start(self):
+        #the reaper's grace period covers last_active touches that have not been flushed yet
+        self._tasks = [
+            asyncio.create_task(self.cache.run_flusher(SESSION_FLUSH_INTERVAL)),
+            asyncio.create_task(self.reaper.run(self.timeout + timedelta(seconds=SESSION_FLUSH_INTERVAL))),
+            asyncio.create_task(self._run_sync()),
+        ]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await self.cache.flush()
+
+    async def create_session(self, user_id: int) -> str:
+        session_id = str(uuid.uuid4())
+        await database.create_session(user_id, session_id)
+        return session_id
+
+    async def get_session(self, token: str) -> Optional[dict]:
+        #rows come with their user already joined, so cached sessions need no user lookup either
+        session = self.cache.get(token)
+        if session is None:
+            session = await database.get_session_with_user(token)
+            if session:
+                self.cache.put(token, session)
+        return session
+
+    async def reload_session(self, token: str) -> Optional[dict]:
+        self.cache.evict(token)
+        return await self.get_session(token)
+
+    def touch_session(self, token: str, session: dict) -> Optional[str]:
+        self.cache.touch(token, datetime.now())
+        return None
+
+    async def delete_session(self, token: str):
+        self.cache.invalidate(token)
+        await database.delete_session(token)
+        expires_at = datetime.now() + timedelta(seconds=SESSION_CACHE_TTL + SESSION_REVOCATION_SYNC)
+        await database.revoke_session(token, expires_at)
+
+    async def _run_sync(self):
+        while True:
+            await asyncio.sleep(SESSION_REVOCATION_SYNC)
+            try:
+                for session_id, _ in await database.get_session_revocations(datetime.now()):
+                    self.cache.invalidate(session_id)
+            except Exception as e:
+                logger.error(f"Refreshing session revocations failed: {e}")
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _b64decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+class SignedTokenBackend(SessionBackend):
+    """
+    Stateless sessions: the cookie is an HMAC-signed token carrying the session
+    id, user id, issue time and last-active time, so checking it needs no
+    database round trip.
+
+    Activity slides the expiry by reissuing the token at most every
+    SESSION_RENEW_INTERVAL seconds. Logged-out session ids go on a small
+    revocation list that is shared through the session_revocations table and
+    refreshed every SESSION_REVOCATION_SYNC seconds; entries only live as long
+    as a token could still be valid.
+    """
+
+    def __init__(self, secret: str, timeout: timedelta):
+        if not secret:
+            raise RuntimeError("SESSION_SECRET must be set to use signed session tokens")
+        self.key = secret.encode()
+        self.timeout = timeout
+        self._revoked: Dict[str, float] = {}  #session id -> epoch seconds after which the entry can go
+        self._task = None
+
+    async def start(self):
+        await self._sync_revocations()
+        self._task = asyncio.create_task(self._run_sync())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    def _sign(self, payload: str) -> str:
+        return _b64encode(hmac.new(self.key, payload.encode(), hashlib.sha256).digest())
+
+    def _issue(self, session_id: str, user_id: int, issued: int, last_active: int) -> str:
+        payload = _b64encode(json.dumps({"sid": session_id, "uid": user_id, "iat": issued, "la": last_active}).encode())
+        return f"{payload}.{self._sign(payload)}"
+
+    async def create_session(self, user_id: int) -> str:
+        now = int(time.time())
+        return self._issue(uuid.uuid4().hex, user_id, now, now)
+
+    async def get_session(self, token: str) -> Optional[dict]:
+        payload, _, signature = token.partition(".")
+        if not signature or not hmac.compare_digest(signature, self._sign(payload)):
+            return None
+        try:
+            claims = json.loads(_b64decode(payload))
+        except ValueError:
+            return None
+        if claims["sid"] in self._revoked:
+            return None
+        return {
+            "id": claims["sid"],
+            "user_id": claims["uid"],
+            "start_time": datetime.fromtimestamp(claims["iat"]),
+            "last_active": datetime.fromtimestamp(claims["la"]),
+        }
+
+    def touch_session(self, token: str, session: dict) -> Optional[str]:
+        now = time.time()
+        if now - session["last_active"].timestamp() < SESSION_RENEW_INTERVAL:
+            return None
+        return self._issue(session["id"], session["user_id"], int(session["start_time"].timestamp()), int(now))
+
+    async def delete_session(self, token: str):
+        session = await self.get_session(token)
+        if session is None:
+            return
+        if time.time() - session["last_active"].timestamp() >= self.timeout.total_seconds():
+            #expired tokens can't be renewed so are dead already; revoking would cost a write per request still sending one
+            return
+        #no token for this session can be issued after now, so it is dead once this one would have expired
+        expires_at = time.time() + self.timeout.total_seconds()
+        self._revoked[session["id"]] = expires_at
+        await database.revoke_session(session["id"], datetime.fromtimestamp(expires_at))
+
+    async def _sync_revocations(self):
+        now = time.time()
+        revoked = await database.get_session_revocations(datetime.fromtimestamp(now))
+        merged = {session_id: expires_at.timestamp() for session_id, expires_at in revoked}
+        merged.update({session_id: expires_at for session_id, expires_at in self._revoked.items() if expires_at > now})
+        self._revoked = merged
+
+    async def _run_sync(self):
+        while True:
+            await asyncio.sleep(SESSION_REVOCATION_SYNC)
+            try:
+                await self._sync_revocations()
+            except Exception as e:
+                logger.error(f"Refreshing session revocations failed: {e}")
+
+
+def create_backend(name: str) -> SessionBackend:
+    if name == "mysql":
+        return MySQLSessionBackend(SESSION_TIMEOUT)
+    if name == "signed":
+        return SignedTokenBackend(SESSION_SECRET, SESSION_TIMEOUT)
+    raise RuntimeError(f"Unknown SESSION_BACKEND {name}")
+
+
+session_backend = create_backend(SESSION_BACKEND)
@@ -0,0 +1,117 @@
+import os
+import time
+import uuid
+from collections import deque
+from typing import Collection, List, Optional
+
+from app import metrics
+
+
+TRACE_BUFFER = int(os.getenv("TRACE_BUFFER", 500))  #completed command traces kept for /api/traces
+TRACED_KINDS = ("command", "cam")
+
+#ingress to finish, so a slow dispense shows up whole rather than only past the default 10s bucket
+TRACE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+STAGE_SECONDS = metrics.Histogram(
+    "petpal_command_stage_seconds", "Time a traced command spent in each stage", ("stage", "kind"), buckets=TRACE_BUCKETS
+)
+
+
+def _stages(trace: dict, arrived: float) -> dict:
+    """
+    Per-stage seconds from a trace the device sent back.
+
+    handler, queue and total use server clocks and device_queue and actuation
+    the device's, so clock skew never leaks into a stage. network is half of
+    the round trip from sending the command to the report arriving, less the
+    time the device held it, up to "reported" when it sent the report; a
+    report kept on the device across a reconnect would otherwise count as
+    network. total ends when the move finished, not when the report arrived.
+    """
+    reported = trace.get("reported", trace["finished"])
+    network = max(0.0, (arrived - trace["sent"] - (reported - trace["received"])) / 2)
+    finished = arrived - network - (reported - trace["finished"])
+    return {
+        "handler": trace["published"] - trace["ingress"],
+        "queue": trace["sent"] - trace["published"],
+        "network": network,
+        "device_queue": trace["started"] - trace["received"],
+        "actuation": trace["finished"] - trace["started"],
+        "total": finished - trace["ingress"],
+    }
+
+
+class CommandTracer:
+    """
+    Follows motor and camera commands from the HTTP request to the end of the move.
+
+    A trace id and timestamps ride along in the command's "trace" field: the
+    request's arrival and publish time, the time the websocket sent it, then
+    the device's receipt and actuation start and end, after which the device
+    sends the whole thing back as {"type": "trace", ...} with the time it sent
+    the report. Camera nudges merged into one message carry the others' traces
+    in "merged_traces", and the device reports each of them. The finished trace
+    is split into stages, recorded in STAGE_SECONDS and kept in a ring buffer
+    of the last TRACE_BUFFER traces. Like the metrics, both are per worker:
+    a trace is kept by the worker the device is connected to.
+    """
+
+    def __init__(self, size: int):
+        self._recent = deque(maxlen=size)
+
+    def stamp(self, message: dict, ingress: Optional[float] = None) -> Optional[str]:
+        """Start a trace on a command about to be published and return its id."""
+        if message["type"] not in TRACED_KINDS:
+            return None
+        now = time.time()
+        trace_id = uuid.uuid4().hex[:16]
+        message["trace"] = {"id": trace_id, "ingress": ingress or now, "published": now}
+        return trace_id
+
+    def sent(self, message: dict) -> dict:
+        """The message to put on the websocket, with the send time added to its traces."""
+        if "trace" not in message:
+            return message
+        now = time.time()
+        message = {**message, "trace": {**message["trace"], "sent": now}}
+        if "merged_traces" in message:
+            message["merged_traces"] = [{**trace, "sent": now} for trace in message["merged_traces"]]
+        return message
+
+    def complete(self, device: str, kind: str, trace: dict, ok: bool = True):
+        """Record a trace the device sent back once it finished the command."""
+        if kind not in TRACED_KINDS:
+            return
+        try:
+            trace_id = trace["id"]
+            stages = _stages(trace, time.time())
+        except (KeyError, TypeError):
+            #a trace missing timestamps, e.g. from a device on older code
+            return
+        for stage, seconds in stages.items():
+            STAGE_SECONDS.observe(seconds, stage, kind)
+        self._recent.append({
+            "id": trace_id,
+            "device": device,
+            "kind": kind,
+            "ok": ok,
+            "ingress": trace["ingress"],
+            "stages": {stage: round(seconds, 4) for stage, seconds in stages.items()},
+        })
+
+    def recent(self, devices: Optional[Collection[str]] = None, trace_id: Optional[str] = None, limit: int = 50) -> List[dict]:
+        """The newest traces first, optionally only those of some devices or one trace."""
+        found = []
+        for entry in reversed(self._recent):
+            if devices is not None and entry["device"] not in devices:
+                continue
+            if trace_id is not None and entry["id"] != trace_id:
+                continue
+            found.append(entry)
+            if len(found) >= limit:
+                break
+        return found
+
+
+command_tracer = CommandTracer(TRACE_BUFFER)
@@ -0,0 +1,176 @@
+import asyncio
+import os
+import time
+from collections import defaultdict, deque
+from typing import Dict, Optional, Set, Tuple, Union
+
+
+VIDEO_CONTROL_INTERVAL = float(os.getenv("VIDEO_CONTROL_INTERVAL", 2.0))  #seconds of frames judged per quality decision
+VIDEO_STEP_DOWN_SKIP = 0.3   #step down when viewers miss more than this share of frames
+VIDEO_STEP_UP_SKIP = 0.05    #step back up after two windows below this share
+
+#(fps, JPEG quality, scale) from best to cheapest, the first is what the device starts at
+VIDEO_LEVELS = [
+    (15, 70, 1.0),
+    (10, 60, 1.0),
+    (10, 50, 0.75),
+    (5, 40, 0.5),
+    (2, 30, 0.5),
+]
+
+
+class Viewer:
+    """One browser watching a device: holds only the newest frame it has not sent yet, plus recent events."""
+
+    def __init__(self):
+        self.skipped = 0
+        self._frame = None
+        self._events = deque(maxlen=16)
+        self._ready = asyncio.Event()
+
+    def offer(self, frame: bytes) -> bool:
+        """Hand over a frame; True if it replaced one the viewer had not got to yet."""
+        skipped = self._frame is not None
+        if skipped:
+            self.skipped += 1
+        self._frame = frame
+        self._ready.set()
+        return skipped
+
+    def notify(self, event: dict):
+        self._events.append(event)
+        self._ready.set()
+
+    async def next_message(self) -> Union[bytes, dict]:
+        """The next event if there is one, else the newest frame."""
+        while self._frame is None and not self._events:
+            self._ready.clear()
+            await self._ready.wait()
+        if self._events:
+            return self._events.popleft()
+        frame, self._frame = self._frame, None
+        return frame
+
+
+class VideoController:
+    """
+    Picks capture settings for one device from how its viewers keep up.
+
+    Capture is paused while nobody watches. Otherwise, every
+    VIDEO_CONTROL_INTERVAL the share of frames that viewers skipped decides
+    whether to step down a VIDEO_LEVELS entry (fewer, smaller frames) or,
+    after two calm windows in a row, back up. Changes are picked up by the
+    device's /ws/live connection with next_settings().
+    """
+
+    def __init__(self):
+        self.level = 0
+        self.paused = True
+        self.version = 0
+        self._offered = 0
+        self._skipped = 0
+        self._calm_windows = 0
+        self._window_start = time.monotonic()
+        self._changed = asyncio.Event()
+
+    def settings(self) -> dict:
+        fps, quality, scale = VIDEO_LEVELS[self.level]
+        return {"type": "video_ctl", "paused": self.paused, "fps": fps, "quality": quality, "scale": scale}
+
+    def _publish_change(self):
+        self.version += 1
+        self._changed.set()
+
+    def viewers_changed(self, count: int):
+        paused = count == 0
+        if paused != self.paused:
+            self.paused = paused
+            self._reset_window()
+            self._publish_change()
+
+    def frame_sent(self, offered: int, skipped: int):
+        self._offered += offered
+        self._skipped += skipped
+        if time.monotonic() - self._window_start >= VIDEO_CONTROL_INTERVAL:
+            self._evaluate()
+
+    def _reset_window(self):
+        self._offered = self._skipped = 0
+        self._window_start = time.monotonic()
+
+    def _evaluate(self):
+        ratio = self._skipped / self._offered if self._offered else 0.0
+        self._reset_window()
+        level = self.level
+        if ratio > VIDEO_STEP_DOWN_SKIP:
+            self._calm_windows = 0
+            level = min(level + 1, len(VIDEO_LEVELS) - 1)
+        elif ratio < VIDEO_STEP_UP_SKIP:
+            self._calm_windows += 1
+            if self._calm_windows >= 2:
+                self._calm_windows = 0
+                level = max(level - 1, 0)
+        else:
+            self._calm_windows = 0
+        if level != self.level:
+            self.level = level
+            self._publish_change()
+
+    async def next_settings(self, seen_version: Optional[int]) -> Tuple[int, dict]:
+        """Current settings as soon as they differ from seen_version (None returns them straight away)."""
+        while self.version == seen_version:
+            self._changed.clear()
+            await self._changed.wait()
+        return self.version, self.settings()
+
+
+class VideoRelay:
+    """
+    Fans JPEG frames from a device's /ws/live connection out to its viewers.
+
+    The device encodes each frame once whatever the number of viewers. Every
+    viewer has a single-frame slot that a newer frame overwrites, so a slow
+    viewer skips frames instead of building up a backlog or holding up others.
+    How many frames get skipped feeds back into the device's capture settings
+    through its VideoController.
+    """
+
+    def __init__(self):
+        self._viewers: Dict[str, Set[Viewer]] = defaultdict(set)
+        self._controllers: Dict[str, VideoController] = {}
+
+    def controller(self, device: str) -> VideoController:
+        controller = self._controllers.get(device)
+        if controller is None:
+            controller = self._controllers[device] = VideoController()
+        return controller
+
+    def join(self, device: str) -> Viewer:
+        viewer = Viewer()
+        self._viewers[device].add(viewer)
+        self.controller(device).viewers_changed(self.viewer_count(device))
+        return viewer
+
+    def leave(self, device: str, viewer: Viewer):
+        viewers = self._viewers.get(device)
+        if viewers is not None:
+            viewers.discard(viewer)
+            if not viewers:
+                del self._viewers[device]
+        self.controller(device).viewers_changed(self.viewer_count(device))
+
+    def publish(self, device: str, frame: bytes):
+        viewers = self._viewers.get(device, ())
+        skipped = sum(viewer.offer(frame) for viewer in viewers)
+        if viewers:
+            self.controller(device).frame_sent(len(viewers), skipped)
+
+    def publish_event(self, device: str, event: dict):
+        for viewer in self._viewers.get(device, ()):
+            viewer.notify(event)
+
+    def viewer_count(self, device: str) -> int:
+        return len(self._viewers.get(device, ()))
+
+
+video_relay = VideoRelay()
@@ -0,0 +1,67 @@
+"""
+Login hashing throughput and event-loop stalls, inline PBKDF2 vs PasswordHasher.
+
+Runs N concurrent logins (the password check only, no database) and a ticker
+coroutine that sleeps 1 ms at a time and records how late it wakes up, which is
+how long the event loop was blocked.
+
+    python -m benchmarks.login_throughput [--logins 40] [--workers 1 2] [--no-ticker]
+"""
+import argparse
+import asyncio
+import hashlib
+import os
+import time
+
+from app.passwords import PASSWORD_ITERATIONS, PasswordHasher, SYSTEM_SALT
+
+
+async def ticker(stalls: list, stop: asyncio.Event):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(0.001)
+        stalls.append(time.perf_counter() - started - 0.001)
+
+
+async def inline_login(password: str):
+    #what the handler did before: PBKDF2 right on the event loop
+    hashlib.pbkdf2_hmac("sha256", password.encode(), SYSTEM_SALT, PASSWORD_ITERATIONS)
+
+
+async def run(label: str, login, logins: int, with_ticker: bool):
+    stalls = []
+    stop = asyncio.Event()
+    tick = asyncio.create_task(ticker(stalls, stop)) if with_ticker else None
+    await asyncio.sleep(0.01)
+    started = time.perf_counter()
+    await asyncio.gather(*(login(f"password{i}") for i in range(logins)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    if tick is not None:
+        await tick
+    worst = f"{max(stalls) * 1000:6.0f} ms" if stalls else "     n/a"
+    print(f"{label:<16} {logins / elapsed:5.1f} logins/s   max loop stall {worst}")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--logins", type=int, default=40)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2])
+    parser.add_argument("--no-ticker", action="store_true")
+    args = parser.parse_args()
+    with_ticker = not args.no_ticker
+
+    print(f"{os.cpu_count()} CPU(s), {PASSWORD_ITERATIONS} iterations, {args.logins} concurrent logins")
+    await run("inline hashlib", inline_login, args.logins, with_ticker)
+    for workers in args.workers:
+        hasher = PasswordHasher(PASSWORD_ITERATIONS, workers, max_pending=args.logins)
+
+        async def pooled_login(password: str):
+            await hasher.verify(password, None)
+
+        await run(f"pool, {workers} worker(s)", pooled_login, args.logins, with_ticker)
+        hasher.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,115 @@
+"""
+I2C transactions and time per camera move, the old per-step servo loop vs PanTilt.
+
+Both drive a fake SMBus that counts calls, on a simulated clock, so this runs
+anywhere and takes no real time. --i2c-ms charges each transaction that much
+bus time, to show how the old loop's hundreds of single-byte writes stretch a
+move on a slow bus while PanTilt's fixed ticks absorb it. Exits 1 if PanTilt
+ever sends more than one transaction per tick.
+
+    python -m benchmarks.pca9685_transactions [--i2c-ms 0.3]
+"""
+import argparse
+import math
+import sys
+
+from RaspberryPi.pca9685 import LED0_ON_L, PCA9685, PCA9685_ADDR, PanTilt
+
+START = (300, 300)
+#(label, pan, tilt) targets from START; a nudge is CAM_STEP = 25 counts
+MOVES = (
+    ("one nudge", 325, 300),
+    ("four merged nudges", 400, 300),
+    ("pan +100, tilt -50", 400, 250),
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.now += seconds
+
+
+class FakeSMBus:
+    """Counts calls and advances the clock by the bus time of each."""
+
+    def __init__(self, clock: FakeClock, cost: float):
+        self.clock = clock
+        self.cost = cost
+        self.transactions = 0
+
+    def _call(self):
+        self.transactions += 1
+        self.clock.now += self.cost
+
+    def read_byte_data(self, address, reg):
+        self._call()
+        return 0
+
+    def write_byte_data(self, address, reg, value):
+        self._call()
+
+    def write_i2c_block_data(self, address, reg, data):
+        self._call()
+
+
+def old_move(bus, clock, start, end):
+    """smooth_set_pwm for pan then tilt, as Final.py did before PanTilt."""
+
+    def set_pwm(channel, on, off):
+        reg = LED0_ON_L + 4 * channel
+        bus.write_byte_data(PCA9685_ADDR, reg, on & 0xFF)
+        bus.write_byte_data(PCA9685_ADDR, reg + 1, on >> 8)
+        bus.write_byte_data(PCA9685_ADDR, reg + 2, off & 0xFF)
+        bus.write_byte_data(PCA9685_ADDR, reg + 3, off >> 8)
+
+    for channel, (begin, finish) in enumerate(zip(start, end)):
+        if begin == finish:
+            continue
+        direction = 1 if finish > begin else -1
+        for pos in range(begin, finish, direction):
+            set_pwm(channel, 0, pos)
+            clock.sleep(0.005)
+        set_pwm(channel, 0, finish)
+
+
+def new_move(bus, clock, start, end):
+    camera = PanTilt(PCA9685(bus), *start, clock=clock, sleep=clock.sleep)
+    bus.transactions = 0
+    began = clock()
+    camera.move_to(*end)
+    ticks = max(1, math.ceil(max(abs(a - b) for a, b in zip(start, end)) / (camera.speed * camera.period)))
+    return began, ticks
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--i2c-ms", type=float, default=0.0, help="simulated bus time per transaction")
+    args = parser.parse_args()
+    cost = args.i2c_ms / 1000
+
+    ok = True
+    print(f"{'move':<20} {'old':>14} {'PanTilt':>14}")
+    for label, pan, tilt in MOVES:
+        clock = FakeClock()
+        bus = FakeSMBus(clock, cost)
+        old_move(bus, clock, START, (pan, tilt))
+        old = (bus.transactions, clock())
+
+        clock = FakeClock()
+        bus = FakeSMBus(clock, cost)
+        began, ticks = new_move(bus, clock, START, (pan, tilt))
+        new = (bus.transactions, clock() - began)
+        ok &= bus.transactions <= ticks
+
+        print(f"{label:<20} {old[0]:>4} tx {old[1]:5.2f}s {new[0]:>4} tx {new[1]:5.2f}s")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Live sensor fan-out load test: many /ws/sensors subscribers on one worker.
+
+Drives SensorHub directly with --subscribers consumers spread over --topics
+device topics; every --slow-every'th consumer takes --slow-delay seconds per
+batch, like a browser on a bad connection. Readings are published on
+subtopics ("<device>/temperature") in bursts, the way the ingestion
+endpoints do. Reports the publish cost per reading and what was delivered
+and dropped, for fast and slow consumers separately.
+
+    python -m benchmarks.sensor_fanout [--subscribers 500] [--readings 2000]
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from app.pubsub import SensorHub
+
+
+async def consume(subscription, delay: float, received: list, index: int):
+    while True:
+        batch = await subscription.next_batch()
+        received[index] += len(json.loads(batch))
+        await asyncio.sleep(delay)
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--subscribers", type=int, default=500)
+    parser.add_argument("--topics", type=int, default=10)
+    parser.add_argument("--readings", type=int, default=2000)
+    parser.add_argument("--burst", type=int, default=20, help="readings published between yields to the loop")
+    parser.add_argument("--buffer", type=int, default=100)
+    parser.add_argument("--slow-every", type=int, default=50)
+    parser.add_argument("--slow-delay", type=float, default=0.5)
+    args = parser.parse_args()
+
+    hub = SensorHub(args.buffer)
+    subscriptions = [hub.subscribe([f"pet{i % args.topics}"]) for i in range(args.subscribers)]
+    slow = [args.slow_every and i % args.slow_every == args.slow_every - 1 for i in range(args.subscribers)]
+    received = [0] * args.subscribers
+    consumers = [
+        asyncio.create_task(consume(sub, args.slow_delay if slow[i] else 0, received, i))
+        for i, sub in enumerate(subscriptions)
+    ]
+
+    publish_seconds = 0.0
+    for n in range(args.readings):
+        reading = {"topic": f"pet{n % args.topics}/temperature", "temp": 20.0 + n % 7, "timestamp": "2026-01-01T00:00:00"}
+        started = time.perf_counter()
+        hub.publish(reading["topic"], reading)
+        publish_seconds += time.perf_counter() - started
+        if n % args.burst == args.burst - 1:
+            await asyncio.sleep(0)
+    #let fast consumers drain; slow ones keep whatever their buffer still holds
+    await asyncio.sleep(0.1)
+    for task in consumers:
+        task.cancel()
+
+    expected = args.readings // args.topics
+    for label, wanted in (("fast", False), ("slow", True)):
+        group = [i for i in range(args.subscribers) if slow[i] == wanted]
+        if not group:
+            continue
+        delivered = sum(received[i] for i in group)
+        dropped = sum(subscriptions[i].dropped for i in group)
+        print(f"{label}: {len(group)} subscribers, {delivered} delivered of {expected * len(group)}, {dropped} dropped")
+    print(f"publish: {publish_seconds / args.readings * 1e6:.0f} us per reading")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
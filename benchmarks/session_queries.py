@@ -0,0 +1,138 @@
+"""
+Seed a scratch database with a million sessions and check the session queries' plans.
+
+Uses the MYSQL_HOST/MYSQL_USER/MYSQL_PASSWORD/MYSQL_PORT settings from the
+environment but its own database (--database, created and migrated if
+missing), so it never touches the app's data. Seeding tops the tables up to
+the requested size, so later runs are quick.
+
+For the reaper's DELETE ... ORDER BY last_active LIMIT and get_user_by_name it
+prints EXPLAIN and fails if the migration 2 index is not used, then times
+both with and without the index.
+
+    python -m benchmarks.session_queries [--database petpal_bench] [--sessions 1000000]
+"""
+import argparse
+import datetime
+import os
+import random
+import sys
+import time
+
+import mysql.connector as mysql
+
+from app.database import open_connection
+from app.migrations import apply_migrations
+
+SEED_BATCH = 10000
+REAPER_DELETE = "DELETE FROM sessions WHERE last_active < %s ORDER BY last_active LIMIT %s"
+USER_BY_NAME = "SELECT * FROM users WHERE name = %s"
+
+
+def create_database(name: str):
+    connection = mysql.connect(
+        user=os.environ["MYSQL_USER"], password=os.environ["MYSQL_PASSWORD"], host=os.environ["MYSQL_HOST"],
+        port=int(os.getenv("MYSQL_PORT", 3306)),
+    )
+    connection.cursor().execute(f"CREATE DATABASE IF NOT EXISTS `{name}`")
+    connection.close()
+
+
+def seed(cursor, connection, users: int, sessions: int, now: datetime.datetime):
+    cursor.execute("SELECT COUNT(*) AS n FROM users")
+    have = cursor.fetchone()["n"]
+    for first in range(have, users, SEED_BATCH):
+        rows = [(f"user{i}", f"user{i}@example.com", "x", "bench") for i in range(first, min(first + SEED_BATCH, users))]
+        cursor.executemany("INSERT INTO users (name, email, password, location) VALUES (%s, %s, %s, %s)", rows)
+        connection.commit()
+
+    cursor.execute("SELECT MIN(id) AS low, MAX(id) AS high FROM users")
+    ids = cursor.fetchone()
+    cursor.execute("SELECT COUNT(*) AS n FROM sessions")
+    have = cursor.fetchone()["n"]
+    started = time.perf_counter()
+    for first in range(have, sessions, SEED_BATCH):
+        rows = []
+        for _ in range(first, min(first + SEED_BATCH, sessions)):
+            #idle times spread over 30 days, so any cutoff expires a predictable share
+            last_active = now - datetime.timedelta(seconds=random.uniform(0, 30 * 86400))
+            rows.append((os.urandom(16).hex(), random.randint(ids["low"], ids["high"]), last_active, last_active))
+        cursor.executemany("INSERT INTO sessions (id, user_id, start_time, last_active) VALUES (%s, %s, %s, %s)", rows)
+        connection.commit()
+    if sessions > have:
+        print(f"seeded {sessions - have} sessions in {time.perf_counter() - started:.0f}s")
+    cursor.execute("ANALYZE TABLE users, sessions")
+    cursor.fetchall()
+
+
+def check_plan(cursor, label: str, query: str, params: tuple, index: str) -> bool:
+    cursor.execute("EXPLAIN " + query, params)
+    plan = cursor.fetchall()
+    for row in plan:
+        print(f"  {label}: table={row['table']} type={row['type']} key={row['key']} rows={row['rows']} extra={row['Extra']}")
+    used = any(row["key"] == index for row in plan)
+    print(f"  {label}: {'uses' if used else 'DOES NOT USE'} {index}")
+    return used
+
+
+def time_query(cursor, query: str, params: tuple, repeat: int) -> float:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        cursor.execute(query, params)
+        cursor.fetchall()
+    return (time.perf_counter() - started) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--database", default="petpal_bench")
+    parser.add_argument("--sessions", type=int, default=1000000)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--batch", type=int, default=1000, help="reaper DELETE batch size")
+    parser.add_argument("--expired-days", type=float, default=29, help="reap sessions idle longer than this")
+    args = parser.parse_args()
+
+    create_database(args.database)
+    os.environ["MYSQL_DATABASE"] = args.database
+    connection = open_connection()
+    cursor = connection.cursor(dictionary=True)
+    apply_migrations(cursor, connection)
+    now = datetime.datetime.now()
+    seed(cursor, connection, args.users, args.sessions, now)
+    cutoff = now - datetime.timedelta(days=args.expired_days)
+
+    print("plans:")
+    ok = check_plan(cursor, "reaper delete", REAPER_DELETE, (cutoff, args.batch), "idx_sessions_last_active")
+    ok &= check_plan(cursor, "user by name", USER_BY_NAME, (f"user{args.users // 2}",), "idx_users_name")
+
+    print("timings:")
+    name = (f"user{args.users // 2}",)
+    indexed = time_query(cursor, USER_BY_NAME, name, 200)
+    scanned = time_query(cursor, "SELECT * FROM users IGNORE INDEX (idx_users_name) WHERE name = %s", name, 20)
+    print(f"  user by name: {indexed * 1000:.2f} ms with the index, {scanned * 1000:.2f} ms without")
+    #a DELETE takes no index hints, so the no-index case is timed on the SELECT it would have to do
+    select = "SELECT id FROM sessions {} WHERE last_active < %s ORDER BY last_active LIMIT %s"
+    indexed = time_query(cursor, select.format(""), (cutoff, args.batch), 20)
+    scanned = time_query(cursor, select.format("IGNORE INDEX (idx_sessions_last_active)"), (cutoff, args.batch), 3)
+    print(f"  reaper batch lookup: {indexed * 1000:.2f} ms with the index, {scanned * 1000:.2f} ms without")
+
+    batches, deleted, slowest = 0, 0, 0.0
+    started = time.perf_counter()
+    while True:
+        batch_started = time.perf_counter()
+        cursor.execute(REAPER_DELETE, (cutoff, args.batch))
+        connection.commit()
+        slowest = max(slowest, time.perf_counter() - batch_started)
+        batches += 1
+        deleted += cursor.rowcount
+        if cursor.rowcount < args.batch:
+            break
+    elapsed = time.perf_counter() - started
+    print(f"  reaper: {deleted} expired sessions in {batches} batches, {elapsed:.2f}s, slowest batch {slowest * 1000:.1f} ms")
+
+    connection.close()
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Frames delivered and frame latency for one slow viewer, fixed vs adaptive capture.
+
+Replays synthetic frames through the real VideoRelay and VideoController: a
+fake camera publishes at the controller's fps (or always at the top
+VIDEO_LEVELS entry for "fixed"), frame size scales with quality * scale^2
+from --frame-kb at the top level, and the viewer spends size / link speed on
+each frame as if sending it. The second half of each run is measured, once
+the controller has settled. Runs in real time, two runs per link.
+
+    python -m benchmarks.video_backpressure [--links 2000 300 100] [--seconds 20] [--interval 1]
+"""
+import argparse
+import asyncio
+import time
+
+from app import video
+from app.video import VIDEO_LEVELS, VideoRelay
+
+
+async def run(adaptive: bool, link: float, frame_bytes: int, seconds: float) -> dict:
+    relay = VideoRelay()
+    controller = relay.controller("bench")
+    viewer = relay.join("bench")
+    top_fps, top_quality, top_scale = VIDEO_LEVELS[0]
+    delivered = []
+
+    async def camera():
+        #does what the Pi's VideoSource does with video_ctl
+        while True:
+            settings = controller.settings()
+            if not adaptive:
+                settings = {"paused": False, "fps": top_fps, "quality": top_quality, "scale": top_scale}
+            if settings["paused"]:
+                await asyncio.sleep(0.05)
+                continue
+            size = frame_bytes * settings["quality"] / top_quality * (settings["scale"] / top_scale) ** 2
+            relay.publish("bench", (time.monotonic(), size))
+            await asyncio.sleep(1 / settings["fps"])
+
+    async def consume():
+        while True:
+            captured, size = await viewer.next_message()
+            await asyncio.sleep(size / link)
+            delivered.append(time.monotonic() - captured)
+
+    tasks = [asyncio.create_task(camera()), asyncio.create_task(consume())]
+    await asyncio.sleep(seconds / 2)
+    delivered.clear()
+    skipped_before = viewer.skipped
+    await asyncio.sleep(seconds / 2)
+    for task in tasks:
+        task.cancel()
+
+    latencies = sorted(delivered) or [0.0]
+    return {
+        "fps": len(delivered) / (seconds / 2),
+        "p50": latencies[len(latencies) // 2] * 1000,
+        "p95": latencies[int(len(latencies) * 0.95)] * 1000,
+        "skipped": viewer.skipped - skipped_before,
+        #a fixed camera ignores the controller, so its level means nothing
+        "level": controller.level if adaptive else "-",
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--links", type=float, nargs="+", default=[2000, 300, 100], help="viewer link speeds in KB/s")
+    parser.add_argument("--seconds", type=float, default=20)
+    parser.add_argument("--interval", type=float, default=1.0, help="VIDEO_CONTROL_INTERVAL for the run")
+    parser.add_argument("--frame-kb", type=float, default=60, help="frame size at the top level")
+    args = parser.parse_args()
+    video.VIDEO_CONTROL_INTERVAL = args.interval
+
+    print(f"{'link':>9}  {'capture':<8} {'fps':>5} {'p50':>7} {'p95':>7} {'skipped':>8} {'level':>6}")
+    for link in args.links:
+        for adaptive in (False, True):
+            result = await run(adaptive, link * 1000, int(args.frame_kb * 1000), args.seconds)
+            print(
+                f"{link:>5.0f}KB/s  {'adaptive' if adaptive else 'fixed':<8} {result['fps']:5.1f}"
+                f" {result['p50']:5.0f}ms {result['p95']:5.0f}ms {result['skipped']:>8} {result['level']:>6}"
+            )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())